@@ -4,10 +4,16 @@ import os.path
 
 try:
     from .package_syncing import logger
+    from .package_syncing import packages
+    from .package_syncing import snapshot
+    from .package_syncing import stats
     from .package_syncing import thread
     from .package_syncing import tools
 except ValueError:
     from package_syncing import logger
+    from package_syncing import packages
+    from package_syncing import snapshot
+    from package_syncing import stats
     from package_syncing import thread
     from package_syncing import tools
 
@@ -15,6 +21,19 @@ log = logger.getLogger(__name__)
 q = thread.Queue()
 
 
+def sync_key(profile):
+    # Queue key of the complete sync of a profile
+    return "sync:%s" % profile if profile else "sync"
+
+
+def is_syncing(settings):
+    return any([q.has(sync_key(profile["profile"])) for profile in tools.load_profiles(settings)])
+
+
+def has_valid_profile(settings):
+    return any([os.path.isdir(profile["sync_folder"]) for profile in tools.load_profiles(settings)])
+
+
 class PkgSyncEnableCommand(sublime_plugin.WindowCommand):
 
     def is_enabled(self):
@@ -52,61 +71,131 @@ class PkgSyncCommand(sublime_plugin.ApplicationCommand):
 
     def is_enabled(self):
         s = tools.load_settings()
-        return s.get("sync", False) and s.get("sync_folder", False) != False
+        return s.get("sync", False) and len(tools.load_profiles(s)) > 0
 
-    def run(self, mode=["pull", "push"], override=False):
-        log.debug("pkg_sync %s %s", mode, override)
+    def run(self, mode=["pull", "push"], override=False, plan=False, startup=False, profile=None):
+        log.debug("pkg_sync %s %s %s %s %s", mode, override, plan, startup, profile)
 
         # Load settings
         settings = sublime.load_settings("Package Syncing.sublime-settings")
+        s = tools.load_settings()
 
         # Check for valid sync_folder
-        if not os.path.isdir(settings.get("sync_folder")):
+        if s.get("sync_folder") and not os.path.isdir(s.get("sync_folder")):
             sublime.error_message("Invalid sync folder \"%s\", sync disabled! Please adjust your sync folder." % settings.get("sync_folder"))
             settings.set("sync", False)
             sublime.save_settings("Package Syncing.sublime-settings")
             return
 
-        # Check if sync is already running
-        if not q.has("sync"):
-            t = thread.Sync(tools.load_settings(), mode, override)
-            q.add(t, "sync")
-        else:
-            print("Package Syncing: Already running")
+        if plan:
+            thread.last_plans.clear()
+
+        # One sync per profile, the first one scans the local folder for all of them
+        scan_local = True
+        for profile_settings in tools.load_profiles(s):
+            name = profile_settings["profile"]
+            if profile is not None and name != profile:
+                continue
+            if not os.path.isdir(profile_settings["sync_folder"]):
+                print("Package Syncing: Invalid sync folder \"%s\" of profile %s, skipped" % (profile_settings["sync_folder"], name))
+                continue
+
+            # Check if sync is already running
+            if not q.has(sync_key(name)):
+                t = thread.Sync(profile_settings, mode, override, dry_run=plan, startup=startup, scan_local=scan_local)
+                q.add(t, sync_key(name))
+                scan_local = False
+            else:
+                print("Package Syncing: Already running")
+
+
+class PkgSyncApplyPlanCommand(sublime_plugin.ApplicationCommand):
+
+    def is_enabled(self):
+        s = tools.load_settings()
+        return s.get("sync", False) and len(thread.last_plans) > 0 and not is_syncing(s)
+
+    def run(self):
+        s = tools.load_settings()
+        for name, sync_plan in sorted(thread.last_plans.items()):
+            log.debug("pkg_sync_apply_plan %s %s", name, sync_plan.mode)
+
+            profile_settings = tools.get_profile(s, name)
+            if not profile_settings:
+                continue
+
+            # The folders are scanned again if the plan is outdated
+            t = thread.Sync(profile_settings, sync_plan.mode, sync_plan.override, cached_plan=sync_plan)
+            q.add(t, sync_key(name))
+        thread.last_plans.clear()
 
 
 class PkgSyncPullItemCommand(sublime_plugin.ApplicationCommand):
 
     def is_enabled(self):
         s = tools.load_settings()
-        return s.get("sync", False) and s.get("sync_folder", False) and os.path.isdir(s.get("sync_folder"))
+        return s.get("sync", False) and has_valid_profile(s)
 
-    def run(self, item):
-        log.debug("pkg_sync_pull_item %s", item)
+    def run(self, item=None, items=None, profile=""):
+        log.debug("pkg_sync_pull_item %s %s %s", profile, item, items)
+        s = tools.load_settings()
+        items = items or [item]
 
-        # Start a thread to pull the current item
-        t = thread.Sync(tools.load_settings(), mode=["pull"], item=item)
+        profile_settings = tools.get_profile(s, profile)
+        if not profile_settings:
+            return
+
+        # An unmounted sync folder looks as if all of its files were deleted
+        if not os.path.isdir(profile_settings["sync_folder"]):
+            log.debug("sync folder %s missing, not pulling", profile_settings["sync_folder"])
+            return
+
+        # Start a thread to pull the current items
+        t = thread.Sync(profile_settings, mode=["pull"], items=items)
         q.add(t)
 
+        # Pulled files are passed on to the other profiles, the local watcher does not report them
+        local_dir = os.path.join(sublime.packages_path(), "User")
+        local_items = [snapshot.make_item(local_dir, i["key"], i.get("version"), i["type"]) for i in items]
+        for other in tools.load_profiles(s):
+            if other["profile"] != profile and os.path.isdir(other["sync_folder"]):
+                push_items = [i for i in local_items if other["matcher"].match_path(i["key"])]
+                if push_items:
+                    q.add(thread.Sync(other, mode=["push"], items=push_items))
+
 
 class PkgSyncPushItemCommand(sublime_plugin.ApplicationCommand):
 
     def is_enabled(self):
         s = tools.load_settings()
-        return s.get("sync", False) and s.get("sync_folder", False) and os.path.isdir(s.get("sync_folder"))
+        return s.get("sync", False) and has_valid_profile(s)
 
-    def run(self, item):
-        log.debug("pkg_sync_push_item %s", item)
+    def run(self, item=None, items=None):
+        log.debug("pkg_sync_push_item %s %s", item, items)
+        items = items or [item]
 
-        # Start a thread to push the current item
-        t = thread.Sync(tools.load_settings(), mode=["push"], item=item)
-        q.add(t)
+        # Start a thread per profile to push the current items which match its filters
+        for profile_settings in tools.load_profiles(tools.load_settings()):
+            push_items = [i for i in items if profile_settings["matcher"].match_path(i["key"])]
+            if push_items and os.path.isdir(profile_settings["sync_folder"]):
+                q.add(thread.Sync(profile_settings, mode=["push"], items=push_items))
+
+
+class PkgSyncStatsCommand(sublime_plugin.WindowCommand):
+
+    def run(self, reset=False):
+        if reset:
+            stats.collector.reset()
+            sublime.status_message("Package Syncing statistics reset")
+            return
+
+        tools.show_panel(self.window, "package_syncing_stats", stats.collector.format())
 
 
 class PkgSyncFolderCommand(sublime_plugin.WindowCommand):
 
     def is_enabled(self):
-        return not q.has("sync")
+        return not is_syncing(tools.load_settings())
 
     def run(self):
         # Load settings to provide an initial value for the input panel
@@ -126,7 +215,7 @@ class PkgSyncFolderCommand(sublime_plugin.WindowCommand):
 
             if os.path.isdir(path):
                 if os.listdir(path):
-                    if sublime.ok_cancel_dialog("The selected folder is not empty, would you like to continue and override your local settings?", "Continue"):
+                    if sublime.ok_cancel_dialog("The selected folder is not empty, would you like to continue and override your local settings?\n\nThe files which would be overridden are shown first, run \"Package Syncing: Apply Sync Plan\" to sync them.", "Continue"):
                         override = True
                     else:
                         self.window.show_input_panel("Sync Folder", path, on_done, None, None)
@@ -144,9 +233,7 @@ class PkgSyncFolderCommand(sublime_plugin.WindowCommand):
                     os.remove(file_path)
 
                 # Reset last-run file
-                file_path = os.path.join(sublime.packages_path(), "User", "Package Syncing.last-run")
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+                tools.reset_last_data()
 
                 sublime.save_settings("Package Syncing.sublime-settings")
                 sublime.status_message("sync_folder successfully set to \"%s\"" % path)
@@ -156,8 +243,8 @@ class PkgSyncFolderCommand(sublime_plugin.WindowCommand):
                 tools.stop_watcher(local=False)
                 tools.start_watcher(tools.load_settings(), local=False)
 
-                # Run pkg_sync
-                sublime.set_timeout(lambda: sublime.run_command("pkg_sync", {"mode": ["pull", "push"], "override": override}), 1000)
+                # Run pkg_sync, an override is only planned until it is applied
+                sublime.set_timeout(lambda: sublime.run_command("pkg_sync", {"mode": ["pull", "push"], "override": override, "plan": override}), 1000)
 
             else:
                 sublime.error_message("Invalid Path %s" % path)
@@ -168,17 +255,34 @@ class PkgSyncFolderCommand(sublime_plugin.WindowCommand):
         self.window.show_input_panel("Sync Folder", sync_folder, on_done, None, None)
 
 
+class PkgSyncListener(sublime_plugin.EventListener):
+
+    def on_post_save(self, view):
+        if not view.file_name():
+            return
+
+        # Push a saved file right away instead of waiting for the next poll of the local watcher,
+        # the coalescer pushes several saves at once, e.g. for Save All
+        item = tools.saved_item(view.file_name())
+        if item:
+            log.debug("saved %s", item["key"])
+            if tools.watcher_local and not tools.watcher_local.stop:
+                tools.watcher_local.watcher.coalescer.add(item)
+            else:
+                sublime.run_command("pkg_sync_push_item", {"item": item})
+        else:
+            # The watchers poll less often while nothing changes, a save should be noticed right away
+            tools.poke_watcher(view.file_name())
+
+
 def plugin_loaded():
     s = sublime.load_settings("Package Syncing.sublime-settings")
     s.clear_on_change("package_syncing")
     s.add_on_change("package_syncing", tools.restart_watcher)
     sublime.save_settings("Package Syncing.sublime-settings")
 
-    # Start watcher
-    sublime.set_timeout(lambda: tools.start_watcher(tools.load_settings()), 100)
-
-    # Run pkg_sync
-    sublime.set_timeout(lambda: sublime.run_command("pkg_sync", {"mode": ["pull", "push"]}), 1000)
+    # Scan, start the watchers and sync only if needed, all off the main thread
+    sublime.set_timeout(lambda: sublime.run_command("pkg_sync", {"mode": ["pull", "push"], "startup": True}), 100)
 
 
 def plugin_unloaded():
@@ -189,6 +293,19 @@ def plugin_unloaded():
     # Stop folder watcher
     tools.stop_watcher()
 
+    # Let a running sync finish, so its last-run data is complete when it is written below
+    if not q.join(2):
+        log.debug("sync still running on unload")
+
+    # Stop the sync worker
+    q.stop()
+
+    # Pending package changes are applied with the next pull
+    packages.reconciler.stop()
+
+    # Write pending last-run data
+    tools.flush_last_data()
+
 
 if sublime.version()[0] == "2":
     plugin_loaded()
@@ -0,0 +1,209 @@
+"""Headless benchmarks for the Package Syncing hot paths.
+
+Usage: python benchmarks/run.py [--files 10000] [--churn 0.01] [--repeat 5] [--json out.json]
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, os.path.join(BENCH_DIR, "stubs"))
+sys.path.insert(1, PACKAGE_DIR)
+sys.path.insert(2, BENCH_DIR)
+
+import trees
+
+
+class Counters(object):
+    # Counts file system calls by wrapping the os functions used by the package
+
+    FUNCTIONS = ["stat", "lstat", "listdir", "scandir", "open", "remove", "rename", "replace", "mkdir", "makedirs", "rmdir", "utime"]
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.bytes_copied = 0
+        self.originals = {}
+        self.lock = threading.Lock()
+
+    def install(self):
+        for name in self.FUNCTIONS:
+            if hasattr(os, name):
+                self.wrap(os, name)
+        self.wrap(__builtins__ if isinstance(__builtins__, dict) else __builtins__.__dict__, "open", item=True)
+
+    def wrap(self, owner, name, item=False):
+        original = owner[name] if item else getattr(owner, name)
+        self.originals[name] = original
+
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.calls[name] += 1
+            return original(*args, **kwargs)
+
+        if item:
+            owner[name] = counted
+        else:
+            setattr(owner, name, counted)
+
+    def reset(self):
+        self.calls.clear()
+        self.bytes_copied = self.copied()
+
+    def copied(self):
+        # Bytes are counted by the copy engine of the package
+        return stats.collector.report()["counters"].get("bytes copied", 0)
+
+    def snapshot(self):
+        return {"syscalls": sum(self.calls.values()), "calls": dict(self.calls), "bytes_copied": self.copied() - self.bytes_copied}
+
+
+counters = Counters()
+counters.install()
+
+import sublime
+from package_syncing import snapshot
+from package_syncing import stats
+from package_syncing import thread
+from package_syncing import tools
+from package_syncing import watcher
+
+
+def load_default_settings():
+    with open(os.path.join(PACKAGE_DIR, "Package Syncing.sublime-settings")) as f:
+        content = re.sub(r"^\s*//.*$", "", f.read(), flags=re.M)
+    return json.loads(content)
+
+
+class NullCoalescer(object):
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, item):
+        self.items += [item]
+
+
+def measure(name, func, repeat=1, verbose=False, setup=None):
+    results = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        # Hide the console output of the package
+        stdout = sys.stdout
+        if not verbose:
+            sys.stdout = open(os.devnull, "w")
+        try:
+            counters.reset()
+            start = time.time()
+            func()
+            wall = time.time() - start
+            results += [dict(counters.snapshot(), wall=wall)]
+        finally:
+            if not verbose:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    best = min(results, key=lambda r: r["wall"])
+    best["name"] = name
+    best["repeat"] = repeat
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--dirs", type=int, default=20)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--churn", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--root", default=None, help="Directory for the generated trees, a temporary one by default")
+    parser.add_argument("--json", default=None, help="Write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the console output of the package")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="pkg-sync-bench-")
+    sublime.root = root
+    local_dir = os.path.join(sublime.packages_path(), "User")
+    remote_dir = os.path.join(root, "Sync")
+
+    trees.reset(local_dir)
+    trees.reset(remote_dir)
+    trees.reset(sublime.installed_packages_path())
+    keys = trees.generate(local_dir, args.files, args.dirs, args.size)
+    trees.age(local_dir)
+
+    s = sublime.load_settings("Package Syncing.sublime-settings")
+    for key, value in load_default_settings().items():
+        s.set(key, value)
+    s.set("sync", True)
+    s.set("sync_folder", remote_dir)
+    settings = tools.load_settings()
+
+    def full_sync():
+        thread.Sync(settings, ["pull", "push"]).run()
+
+    def idle_poll():
+        w.loop()
+
+    def save_last_data():
+        tools.save_last_data(last_local_data=snapshot_data.local.data(), last_remote_data=snapshot_data.remote.data())
+        tools.flush_last_data()
+
+    def single_item(mode, path, key):
+        item = {"type": "m", "key": key, "path": os.path.join(path, key), "dir": os.path.dirname(key)}
+
+        def setup():
+            trees.write(item["path"], args.size)
+            item["version"] = os.path.getmtime(item["path"])
+
+        def run():
+            thread.Sync(settings, [mode], items=[dict(item)]).run()
+        return setup, run
+
+    results = []
+    results += [measure("full sync (initial push)", full_sync, verbose=args.verbose)]
+    results += [measure("full sync (no changes)", full_sync, args.repeat, verbose=args.verbose)]
+
+    changed = trees.churn(remote_dir, keys, args.churn, args.size)
+    results += [measure("full sync (%s remote changes)" % len(changed), full_sync, verbose=args.verbose)]
+
+    # Only the mtimes differ, every file is compared but none copied
+    trees.age(remote_dir, 60)
+    results += [measure("full sync (all remote mtimes changed)", full_sync, verbose=args.verbose)]
+
+    w = watcher.Watcher(remote_dir, NullCoalescer(), tools.load_matcher(settings))
+    w.start()
+    results += [measure("idle poll", idle_poll, args.repeat, verbose=args.verbose)]
+
+    snapshot_data = snapshot.get_snapshot(local_dir, remote_dir, tools.load_matcher(settings))
+    results += [measure("save last data", save_last_data, args.repeat, verbose=args.verbose)]
+
+    setup, run = single_item("pull", remote_dir, keys[0])
+    results += [measure("single item pull", run, args.repeat, verbose=args.verbose, setup=setup)]
+    setup, run = single_item("push", local_dir, keys[1])
+    results += [measure("single item push", run, args.repeat, verbose=args.verbose, setup=setup)]
+
+    print("%d files, churn %s, best of %d" % (args.files, args.churn, args.repeat))
+    print("%-36s %10s %10s %12s" % ("scenario", "wall ms", "syscalls", "bytes copied"))
+    for r in results:
+        print("%-36s %10.1f %10d %12d" % (r["name"], r["wall"] * 1000, r["syscalls"], r["bytes_copied"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4)
+
+    if not args.root:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Minimal stand-in for the sublime module, just enough to run Package Syncing headless
+import os
+import threading
+
+root = os.environ.get("PKG_SYNC_BENCH_ROOT", os.path.join(os.getcwd(), "bench-data"))
+commands = []
+settings = {}
+
+
+def version():
+    return "3211"
+
+
+def platform():
+    return "linux"
+
+
+def packages_path():
+    return os.path.join(root, "Packages")
+
+
+def installed_packages_path():
+    return os.path.join(root, "Installed Packages")
+
+
+def set_timeout(callback, delay=0):
+    if delay:
+        t = threading.Timer(delay / 1000.0, callback)
+        t.daemon = True
+        t.start()
+    else:
+        callback()
+
+
+def set_timeout_async(callback, delay=0):
+    set_timeout(callback, delay)
+
+
+def run_command(cmd, args=None):
+    commands.append((cmd, args))
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    print("error_message: %s" % msg)
+
+
+def ok_cancel_dialog(msg, ok_title=""):
+    return True
+
+
+def active_window():
+    return None
+
+
+class Settings(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def erase(self, key):
+        self.data.pop(key, None)
+
+    def has(self, key):
+        return key in self.data
+
+    def add_on_change(self, tag, callback):
+        pass
+
+    def clear_on_change(self, tag):
+        pass
+
+
+def load_settings(name):
+    if name not in settings:
+        settings[name] = Settings()
+    return settings[name]
+
+
+def save_settings(name):
+    pass
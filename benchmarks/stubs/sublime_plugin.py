@@ -0,0 +1,21 @@
+# Minimal stand-in for the sublime_plugin module
+
+
+class ApplicationCommand(object):
+    pass
+
+
+class WindowCommand(object):
+
+    def __init__(self, window=None):
+        self.window = window
+
+
+class TextCommand(object):
+
+    def __init__(self, view=None):
+        self.view = view
+
+
+class EventListener(object):
+    pass
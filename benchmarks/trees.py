@@ -0,0 +1,52 @@
+import os
+import random
+import shutil
+
+EXTENSIONS = [".sublime-settings", ".sublime-keymap", ".sublime-snippet", ".sublime-build", ".tmTheme"]
+
+
+def reset(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+def generate(path, files=1000, dirs=20, size=512):
+    # Builds a Packages/User like tree with files spread over dirs sub directories
+    keys = []
+    for i in range(files):
+        sub_dir = "" if i % (dirs + 1) == 0 else "dir%03d" % (i % (dirs + 1))
+        key = os.path.join(sub_dir, "file%05d%s" % (i, EXTENSIONS[i % len(EXTENSIONS)]))
+        write(os.path.join(path, key), size)
+        keys += [key]
+
+    # Files which are never synced
+    write(os.path.join(path, "ignored.py"), size)
+    write(os.path.join(path, "Package Control.cache", "cached.json"), size)
+    return keys
+
+
+def write(path, size):
+    dir_name = os.path.dirname(path)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+
+def age(path, seconds=3600):
+    # Move all mtimes into the past, so new writes are always newer
+    for root, dir_names, file_names in os.walk(path):
+        for name in dir_names + file_names:
+            full_path = os.path.join(root, name)
+            st = os.stat(full_path)
+            os.utime(full_path, (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+def churn(path, keys, ratio=0.01, size=512, seed=2):
+    # Rewrites a share of the files, returns the changed keys
+    rnd = random.Random(seed)
+    changed = rnd.sample(keys, max(1, int(len(keys) * ratio)))
+    for key in changed:
+        write(os.path.join(path, key), size)
+    return changed
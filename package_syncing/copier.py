@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from . import delta
+    from . import logger
+    from . import state
+except ValueError:
+    from package_syncing import delta
+    from package_syncing import logger
+    from package_syncing import state
+
+log = logger.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".pkg-sync-part"
+
+
+def run(func, items, concurrency=4):
+    # Calls func for every item on a bounded number of threads and returns
+    # (item, result, error) tuples in the order of items
+    results = [None] * len(items)
+
+    pending = queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception as e:
+                log.debug("Error for %s: %s", item, e)
+                results[i] = (item, None, e)
+
+    concurrency = max(1, min(concurrency, len(items)))
+    if concurrency == 1:
+        worker()
+        return results
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def part_path(target, st):
+    # The name depends on the source, so a partial copy is only resumed for an unchanged source
+    # A rewrite within the same second must not resume the older content, so the full precision
+    # of the mtime is used, Python 2 has no st_mtime_ns
+    mtime = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1000000)
+    return "%s.%x-%x%s" % (target, st.st_size, mtime, PART_SUFFIX)
+
+
+def remove_parts(folder, prefix="", keep=()):
+    # Removes the partial copies in folder which start with prefix and are not in keep,
+    # they were left behind for an older or deleted source
+    try:
+        names = os.listdir(folder or ".")
+    except OSError:
+        return
+    for part in names:
+        path = os.path.join(folder, part)
+        if part.startswith(prefix) and part.endswith(PART_SUFFIX) and path not in keep:
+            try:
+                os.remove(path)
+                log.debug("removed stale %s", path)
+            except OSError as e:
+                log.debug("Could not remove %s: %s", path, e)
+
+
+def copy_file(source, target, chunk_size=CHUNK_SIZE, progress=None, blocks=None, block_size=delta.BLOCK_SIZE):
+    # Streams source into a temporary file next to target and renames it when complete,
+    # an interrupted copy never leaves a half written target behind. If blocks is a list
+    # it is filled with the block digests of the copied content, chunk_size has to be a
+    # multiple of block_size then
+    st = os.stat(source)
+    temp_path = part_path(target, st)
+
+    # Resume a previous copy, the last chunk might be incomplete
+    offset = 0
+    if os.path.isfile(temp_path):
+        offset = min(os.path.getsize(temp_path), st.st_size)
+        offset -= offset % chunk_size
+        log.debug("resuming %s at %s", target, offset)
+
+        # Digests of a resumed copy would be incomplete
+        blocks = None
+
+    with open(source, "rb") as src:
+        with open(temp_path, "r+b" if offset else "wb") as dst:
+            src.seek(offset)
+            dst.seek(offset)
+            dst.truncate()
+
+            copied = offset
+            while True:
+                # Small files should not allocate a whole chunk
+                chunk = src.read(max(1, min(chunk_size, st.st_size - copied)))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                copied += len(chunk)
+                if blocks is not None:
+                    blocks += [delta.block_digest(chunk[i:i + block_size]) for i in range(0, len(chunk), block_size)]
+                if progress:
+                    progress(copied, st.st_size)
+
+    shutil.copystat(source, temp_path)
+    state.replace_file(temp_path, target)
+    return st.st_size - offset
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import shutil
+
+try:
+    from . import logger
+    from . import state
+except ValueError:
+    from package_syncing import logger
+    from package_syncing import state
+
+log = logger.getLogger(__name__)
+
+BLOCK_SIZE = 16 * 1024
+# Smaller files are always copied as a whole
+MIN_BLOCKS = 4
+# Patching is only worth it if at most this share of the blocks changed
+MAX_CHANGED_RATIO = 0.5
+
+
+def block_digest(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def file_blocks(path, block_size=BLOCK_SIZE):
+    blocks = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            blocks += [block_digest(data)]
+    return blocks
+
+
+class Signatures(object):
+
+    def __init__(self, cache, block_size=BLOCK_SIZE, folders=()):
+        # Path -> [mtime, size, block_size, block digests], stored in the last-run data relative to folders
+        self.cache = cache
+        self.block_size = block_size
+        self.folders = folders
+
+    def get(self, path):
+        # Only valid as long as the file was not changed since the signature was taken
+        cached = self.cache.get(state.short_path(path, self.folders))
+        if not cached:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if cached[0] != st.st_mtime or cached[1] != st.st_size or cached[2] != self.block_size:
+            return None
+        return cached[3]
+
+    def set(self, path, blocks):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        name = state.short_path(path, self.folders)
+        if len(blocks) >= MIN_BLOCKS:
+            self.cache[name] = [st.st_mtime, st.st_size, self.block_size, blocks]
+        else:
+            self.cache.pop(name, None)
+
+    def remove(self, path):
+        self.cache.pop(state.short_path(path, self.folders), None)
+
+
+def patch(source, target, target_blocks, block_size=BLOCK_SIZE):
+    # Writes only the blocks of source which differ from target_blocks into target,
+    # returns (bytes written, source blocks) or None if a full copy is cheaper
+    size = os.path.getsize(source)
+    if size < MIN_BLOCKS * block_size:
+        return None
+
+    source_blocks = file_blocks(source, block_size)
+    changed = [i for i, digest in enumerate(source_blocks) if i >= len(target_blocks) or target_blocks[i] != digest]
+    if len(changed) > MAX_CHANGED_RATIO * len(source_blocks):
+        log.debug("%s of %s blocks changed, full copy of %s", len(changed), len(source_blocks), target)
+        return None
+
+    written = 0
+    with open(source, "rb") as src:
+        with open(target, "r+b") as dst:
+            for i in changed:
+                src.seek(i * block_size)
+                dst.seek(i * block_size)
+                data = src.read(block_size)
+                dst.write(data)
+                written += len(data)
+            dst.truncate(size)
+
+    shutil.copystat(source, target)
+    log.debug("patched %s blocks of %s", len(changed), target)
+    return written, source_blocks
@@ -0,0 +1,134 @@
+try:
+    from . import snapshot
+except ValueError:
+    from package_syncing import snapshot
+
+PULL = "pull"
+PUSH = "push"
+
+# Order in which the changes of a plan are applied
+ORDER = {"d": 0, "c": 1, "m": 2}
+LABELS = {"d": "delete", "c": "create", "m": "update"}
+
+
+class Change(object):
+
+    __slots__ = ("type", "key", "version")
+
+    def __init__(self, type, key, version=None):
+        self.type = type
+        self.key = key
+        self.version = version
+
+    def item(self, folder):
+        # Item format of the watchers, only built for changes which are applied
+        return snapshot.make_item(folder, self.key, self.version, self.type)
+
+    def __repr__(self):
+        return "%s %s" % (self.type, self.key)
+
+
+class Plan(object):
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.changes = []
+        # Keys changed on both sides since the last sync
+        self.conflicts = []
+        # Keys which differ, but were already synced before
+        self.unchanged = 0
+        # Key -> bytes to copy, only filled for reports
+        self.sizes = {}
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __repr__(self):
+        return "<Plan %s %s, conflicts %s>" % (self.direction, self.changes, self.conflicts)
+
+    def items(self, folder):
+        # Items with the paths of the source folder
+        return [change.item(folder) for change in self.changes]
+
+    def counts(self):
+        counts = {"c": 0, "m": 0, "d": 0}
+        for change in self.changes:
+            counts[change.type] += 1
+        return counts
+
+    def format(self):
+        counts = self.counts()
+        lines = ["%s: %d created, %d updated, %d deleted, %s" % (self.direction.capitalize(), counts["c"], counts["m"], counts["d"], format_size(sum(self.sizes.values())))]
+        for change in self.changes:
+            size = " (%s)" % format_size(self.sizes[change.key]) if change.key in self.sizes else ""
+            lines += ["    %-6s %s%s" % (LABELS[change.type], change.key, size)]
+        if self.conflicts:
+            lines += ["    Changed on both sides, the newer version wins: %s" % ", ".join(sorted(self.conflicts))]
+        return lines
+
+
+def format_size(size):
+    if size < 1024:
+        return "%d bytes" % size
+    if size < 1024 * 1024:
+        return "%.1f KB" % (size / 1024.0)
+    return "%.1f MB" % (size / (1024.0 * 1024))
+
+
+def compute(direction, local, remote, last_local, last_remote, override=False):
+    # Three-way diff of the current local and remote files against the last sync,
+    # every argument maps keys to versions. Returns the changes to apply in the
+    # given direction, each key is looked up once so this is linear in the keys
+    if direction == PULL:
+        source, target, last_source, last_target = remote, local, last_remote, last_local
+    else:
+        source, target, last_source, last_target = local, remote, last_local, last_remote
+
+    plan = Plan(direction)
+    changes = plan.changes
+
+    # Files deleted in the source since the last sync are deleted in the target
+    for key in last_source:
+        if key not in source:
+            changes.append(Change("d", key))
+
+    for key, version in source.items():
+        last = last_target.get(key)
+
+        # Deleted in the target, the deletion is applied in the other direction
+        if last is not None and key not in target:
+            continue
+
+        current = target.get(key)
+        if current is None:
+            change_type = "c"
+        elif override or int(version) > int(current):
+            change_type = "m"
+        else:
+            continue
+
+        if last == version:
+            plan.unchanged += 1
+            continue
+
+        # Both sides changed since the last sync, the newer version wins
+        last_version = last_source.get(key)
+        if current is not None and last is not None and last_version is not None:
+            if current != last and version != last_version:
+                plan.conflicts.append(key)
+
+        changes.append(Change(change_type, key, version))
+
+    changes.sort(key=lambda change: (ORDER[change.type], change.key))
+    return plan
+
+
+def applied(plan, local):
+    # Local data after a pull plan was applied, copies keep the version of the remote file
+    local = dict(local)
+    for change in plan.changes:
+        if change.type == "d":
+            local.pop(change.key, None)
+        else:
+            local[change.key] = change.version
+    return local
@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+try:
+    from . import state
+except ValueError:
+    from package_syncing import state
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_hash(path, chunk_size=CHUNK_SIZE):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Fingerprints(object):
+
+    def __init__(self, cache, folders=()):
+        # Path -> [mtime, size, hash], stored in the last-run data relative to folders
+        self.cache = cache
+        self.folders = folders
+
+    def get(self, path, st=None):
+        st = st or os.stat(path)
+
+        name = state.short_path(path, self.folders)
+        cached = self.cache.get(name)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+
+        digest = file_hash(path)
+        self.cache[name] = [st.st_mtime, st.st_size, digest]
+        return digest
+
+    def remove(self, path):
+        self.cache.pop(state.short_path(path, self.folders), None)
+
+    def same_content(self, source, target):
+        try:
+            source_st = os.stat(source)
+            target_st = os.stat(target)
+        except OSError:
+            return False
+
+        # Different sizes can never be the same content
+        if source_st.st_size != target_st.st_size:
+            return False
+
+        # Same size and mtime, most likely copied by us before
+        if source_st.st_mtime == target_st.st_mtime:
+            return True
+
+        # Ambiguous, compare the content
+        try:
+            return self.get(source, source_st) == self.get(target, target_st)
+        except (IOError, OSError):
+            return False
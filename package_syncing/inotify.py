@@ -0,0 +1,125 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+# Flags taken from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Events which could change the state of a watched file
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def load_libc():
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+def available():
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = load_libc()
+        return hasattr(libc, "inotify_init1")
+    except (OSError, AttributeError):
+        return False
+
+
+class Event(object):
+
+    __slots__ = ("wd", "mask", "cookie", "name")
+
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    def __repr__(self):
+        return "<Event wd=%s mask=%#x name=%r>" % (self.wd, self.mask, self.name)
+
+
+class Inotify(object):
+
+    def __init__(self):
+        self.libc = load_libc()
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            self.raise_error()
+
+    def raise_error(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        encoded_path = path.encode(sys.getfilesystemencoding()) if not isinstance(path, bytes) else path
+        wd = self.libc.inotify_add_watch(self.fd, encoded_path, mask)
+        if wd < 0:
+            self.raise_error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # The kernel drops the watch on its own if the directory is gone
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding(), "replace")
+            offset += length
+            events += [Event(wd, mask, cookie, name)]
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -4,17 +4,25 @@ import sublime_plugin
 import logging
 
 LOG = False
+# Trace points are in the hot paths, they are only kept if TRACE_LOG is set as well
+TRACE_LOG = False
 TRACE = 9
 BASIC_FORMAT = "[%(asctime)s - %(levelname)s - %(filename)s %(funcName)s] %(message)s"
 
-logging.addLevelName("TRACE", TRACE)
+logging.addLevelName(TRACE, "TRACE")
+
+loggers = {}
+
+
+def noop(*args, **kwargs):
+    pass
 
 
 class CustomLogger(logging.Logger):
 
     def isEnabledFor(self, level):
         if not LOG:
-            return
+            return False
         return level >= self.getEffectiveLevel()
 
     def trace(self, msg="", *args, **kwargs):
@@ -23,6 +31,10 @@ class CustomLogger(logging.Logger):
 
 
 def getLogger(name, level=logging.DEBUG):
+    # Only one logger and handler per name
+    if name in loggers:
+        return loggers[name]
+
     log = CustomLogger(name, level)
 
     # Set stream handler
@@ -30,4 +42,13 @@ def getLogger(name, level=logging.DEBUG):
     h.setFormatter(logging.Formatter(BASIC_FORMAT))
 
     log.addHandler(h)
+
+    # Disabled loggers skip the call into logging, the arguments are never formatted
+    if not LOG:
+        for method in ("debug", "info", "warning", "error", "critical", "exception", "log"):
+            setattr(log, method, noop)
+    if not LOG or not TRACE_LOG:
+        log.trace = noop
+
+    loggers[name] = log
     return log
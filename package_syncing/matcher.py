@@ -0,0 +1,105 @@
+import fnmatch
+import os
+import re
+import threading
+
+# Files of the package itself, never synced
+DEFAULT_FILES_TO_IGNORE = ["Package Syncing.sublime-settings", "Package Syncing.last-run", "Package Syncing.*.last-run", "Package Syncing.*pack-index", "*.pkg-sync-part"]
+
+WILDCARDS = re.compile(r"[*?\[]")
+
+matchers = {}
+matchers_lock = threading.Lock()
+
+
+def get_matcher(files_to_include=[], files_to_ignore=[], dirs_to_ignore=[]):
+    key = (tuple(files_to_include), tuple(files_to_ignore), tuple(dirs_to_ignore))
+    with matchers_lock:
+        if key not in matchers:
+            matchers[key] = Matcher(files_to_include, files_to_ignore, dirs_to_ignore)
+        return matchers[key]
+
+
+def get_union_matcher(members):
+    # One matcher for the files of several profiles, a single matcher is returned as is
+    members = sorted(set(members), key=lambda member: member.key)
+    if len(members) == 1:
+        return members[0]
+
+    key = ("union",) + tuple([member.key for member in members])
+    with matchers_lock:
+        if key not in matchers:
+            matchers[key] = UnionMatcher(key, members)
+        return matchers[key]
+
+
+class PatternSet(object):
+
+    def __init__(self, patterns):
+        self.names = set()
+        self.suffixes = []
+        regex_patterns = []
+
+        for pattern in patterns:
+            pattern = os.path.normcase(pattern)
+            if not WILDCARDS.search(pattern):
+                # Plain names just need a set lookup
+                self.names.add(pattern)
+            elif pattern.startswith("*") and not WILDCARDS.search(pattern[1:]):
+                # Suffix globs like *.sublime-keymap, "*" matches path separators as well
+                self.suffixes += [pattern[1:]]
+            else:
+                regex_patterns += ["(?:%s)" % fnmatch.translate(pattern)]
+
+        self.suffixes = tuple(self.suffixes)
+        self.regex = re.compile("|".join(regex_patterns)) if regex_patterns else None
+
+    def match(self, path):
+        if path in self.names:
+            return True
+        if self.suffixes and path.endswith(self.suffixes):
+            return True
+        if self.regex and self.regex.match(path):
+            return True
+        return False
+
+
+class Matcher(object):
+
+    def __init__(self, files_to_include=[], files_to_ignore=[], dirs_to_ignore=[]):
+        self.key = (tuple(files_to_include), tuple(files_to_ignore), tuple(dirs_to_ignore))
+
+        self.include = PatternSet(files_to_include)
+        self.ignore = PatternSet(list(files_to_ignore) + DEFAULT_FILES_TO_IGNORE)
+        self.dirs_to_ignore = frozenset(dirs_to_ignore)
+
+    def match(self, rel_path):
+        rel_path = os.path.normcase(rel_path)
+        return self.include.match(rel_path) and not self.ignore.match(rel_path)
+
+    def ignore_dir(self, name):
+        return name in self.dirs_to_ignore
+
+    def match_path(self, rel_path):
+        # Same as match, but also checks the directories of a relative path
+        dir_names = os.path.dirname(rel_path).split(os.sep)
+        if any([self.ignore_dir(d) for d in dir_names]):
+            return False
+        return self.match(rel_path)
+
+
+class UnionMatcher(object):
+
+    def __init__(self, key, members):
+        # Matches a file if any member does, a directory is only skipped if all members ignore it
+        self.key = key
+        self.members = members
+
+    def match(self, rel_path):
+        return any([member.match(rel_path) for member in self.members])
+
+    def ignore_dir(self, name):
+        return all([member.ignore_dir(name) for member in self.members])
+
+    def match_path(self, rel_path):
+        return any([member.match_path(rel_path) for member in self.members])
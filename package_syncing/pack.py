@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    from . import copier
+    from . import logger
+    from . import state
+except ValueError:
+    from package_syncing import copier
+    from package_syncing import logger
+    from package_syncing import state
+
+log = logger.getLogger(__name__)
+
+INDEX_PREFIX = "Package Syncing."
+INDEX_SUFFIX = ".pack-index"
+PACK_DIR = "Package Syncing.packs"
+PACK_SUFFIX = ".pack"
+# Packs are rewritten once more than half of their bytes belong to unused objects
+MIN_COMPACT_SIZE = 64 * 1024
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(folder, machine):
+    with stores_lock:
+        if folder not in stores:
+            stores[folder] = PackStore(folder, machine)
+        return stores[folder]
+
+
+def index_name(machine):
+    # Every machine only writes its own index, the indexes of all machines are merged on read
+    return "%s%s%s" % (INDEX_PREFIX, machine, INDEX_SUFFIX)
+
+
+def stamp(entry):
+    # Time of the change, entries of a single shared index have none
+    return entry[3] if len(entry) > 3 else 0
+
+
+def merge(indexes):
+    # Newest entry of every key across the indexes, deleted keys have a newer entry
+    # without version. Returns the live files, all objects and the winning entries
+    entries = {}
+    objects = {}
+    for files, index_objects in indexes:
+        objects.update(index_objects)
+        for key, entry in files.items():
+            if key not in entries or stamp(entry) > stamp(entries[key]):
+                entries[key] = entry
+    files = dict([(key, entry[:3]) for key, entry in entries.items() if entry[0] is not None])
+    return files, objects, entries
+
+
+def to_name(key):
+    # Keys are stored with forward slashes, so the index is shared across platforms
+    return key.replace(os.sep, "/")
+
+
+def to_key(name):
+    return name.replace("/", os.sep)
+
+
+class Batch(object):
+
+    def __init__(self, store):
+        # Changes within the batch are written together, does nothing without a store
+        self.store = store
+
+    def __enter__(self):
+        if self.store:
+            self.store.begin()
+        return self.store
+
+    def __exit__(self, *args):
+        if self.store:
+            self.store.end()
+
+
+class PackStore(object):
+
+    def __init__(self, folder, machine):
+        self.folder = folder
+        self.machine = machine
+        self.index_path = os.path.join(folder, index_name(machine))
+        self.pack_dir = os.path.join(folder, PACK_DIR)
+
+        # Entries written by this machine, key -> [version, size, hash, time] with version
+        # None for deleted keys, and hash -> [pack, offset, length] of the objects in its packs
+        self.own = {}
+        self.own_objects = {}
+        # Index name -> (mtime, files, objects) as read from the sync folder
+        self.indexes = {}
+        # Merged view of all machines, key -> [version, size, hash] and hash -> [pack, offset, length]
+        self.files = {}
+        self.objects = {}
+        self.entries = {}
+        # Packs written by this machine, only these are ever removed by it
+        self.packs = set()
+        self.scans = {}
+
+        self.loaded = None
+        self.depth = 0
+        self.dirty = False
+        self.pack = None
+        self.lock = threading.RLock()
+
+    def pack_path(self, name):
+        return os.path.join(self.pack_dir, name)
+
+    def index_mtimes(self):
+        mtimes = {}
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith(INDEX_PREFIX) and name.endswith(INDEX_SUFFIX):
+                try:
+                    mtimes[name] = os.stat(os.path.join(self.folder, name)).st_mtime
+                except OSError:
+                    pass
+        return mtimes
+
+    def load(self):
+        # Indexes are only read again after their machine changed them
+        with self.lock:
+            if self.depth:
+                return
+
+            mtimes = self.index_mtimes()
+            if mtimes == self.loaded:
+                return
+
+            for name, mtime in mtimes.items():
+                if name in self.indexes and self.indexes[name][0] == mtime:
+                    continue
+                try:
+                    with open(os.path.join(self.folder, name), "r") as f:
+                        data = json.load(f)
+                    files = dict([(to_key(key_name), entry) for key_name, entry in data["files"].items()])
+                    self.indexes[name] = (mtime, files, data["objects"])
+                except (IOError, OSError, ValueError, KeyError) as e:
+                    # Keep the previous state of an index which is written right now
+                    log.warning("Error while reading %s: %s", name, e)
+
+            # An index which is gone for a moment, e.g. while a cloud drive replaces it,
+            # keeps its last state. Its files must not look deleted
+            own = self.indexes.get(index_name(self.machine))
+            self.own = dict(own[1]) if own else {}
+            self.own_objects = dict(own[2]) if own else {}
+            self.packs = set([value[0] for value in self.own_objects.values()])
+            self.merge()
+            self.loaded = mtimes
+            log.debug("loaded %s indexes of %s with %s files", len(self.indexes), self.folder, len(self.files))
+
+    def merge(self):
+        indexes = [(files, objects) for name, (mtime, files, objects) in self.indexes.items() if name != index_name(self.machine)]
+        self.files, self.objects, self.entries = merge(indexes + [(self.own, self.own_objects)])
+        self.scans = {}
+
+    def version(self, key):
+        with self.lock:
+            entry = self.files.get(key)
+        return entry[0] if entry else None
+
+    def scan(self, matcher):
+        # Key -> version like the scanner, keys are the paths in a mirrored folder
+        with self.lock:
+            self.load()
+            if matcher.key not in self.scans:
+                self.scans[matcher.key] = dict([(key, entry[0]) for key, entry in self.files.items() if matcher.match_path(key)])
+            return dict(self.scans[matcher.key])
+
+    def hash(self, key):
+        with self.lock:
+            self.load()
+            entry = self.files.get(key)
+        return entry[2] if entry else None
+
+    def size(self, key):
+        with self.lock:
+            self.load()
+            entry = self.files.get(key)
+        return entry[1] if entry else None
+
+    def read(self, key):
+        with self.lock:
+            self.load()
+            entry = self.files.get(key)
+            if not entry or entry[2] not in self.objects:
+                raise IOError("%s is not in the pack indexes of %s" % (key, self.folder))
+            name, offset, length = self.objects[entry[2]]
+
+        with open(self.pack_path(name), "rb") as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length))
+
+        if hashlib.sha1(data).hexdigest() != entry[2]:
+            raise IOError("Corrupted object for %s in %s" % (key, name))
+        return data, entry[0]
+
+    def extract(self, key, target):
+        # Writes the content of key to target with its version as modification time
+        data, version = self.read(key)
+
+        temp_path = target + copier.PART_SUFFIX
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.utime(temp_path, (version, version))
+        state.replace_file(temp_path, target)
+        return len(data)
+
+    def add(self, key, path):
+        # Stores the content of path as key, returns the number of bytes written to the pack
+        version = os.stat(path).st_mtime
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        written = 0
+        with Batch(self):
+            with self.lock:
+                # Content addressed, the same content is only stored once per machine. Objects
+                # of other machines are not shared, they remove them without knowing about us
+                if digest not in self.own_objects:
+                    compressed = zlib.compress(data)
+                    name, f = self.open_pack()
+                    self.own_objects[digest] = [name, f.tell(), len(compressed)]
+                    f.write(compressed)
+                    written = len(compressed)
+
+                self.own[key] = [version, len(data), digest, time.time()]
+                self.changed()
+        return written
+
+    def remove(self, key):
+        with Batch(self):
+            with self.lock:
+                if key not in self.files:
+                    return False
+                # Deleted keys are kept, so they win over older entries of other machines
+                self.own[key] = [None, None, None, time.time()]
+                self.changed()
+                return True
+
+    def changed(self):
+        self.dirty = True
+        self.merge()
+
+    def begin(self):
+        with self.lock:
+            self.load()
+            self.depth += 1
+
+    def end(self):
+        with self.lock:
+            self.depth -= 1
+            if not self.depth and self.dirty:
+                self.commit()
+
+    def open_pack(self):
+        if not self.pack:
+            if not os.path.isdir(self.pack_dir):
+                os.makedirs(self.pack_dir)
+            name = "%x-%s%s" % (int(time.time()), uuid.uuid4().hex[:8], PACK_SUFFIX)
+            self.pack = (name, open(self.pack_path(name) + copier.PART_SUFFIX, "wb"))
+            self.packs.add(name)
+        return self.pack
+
+    def close_pack(self):
+        if self.pack:
+            name, f = self.pack
+            f.close()
+            state.replace_file(self.pack_path(name) + copier.PART_SUFFIX, self.pack_path(name))
+            self.pack = None
+
+    def commit(self):
+        # The new pack has to be complete before the index refers to it
+        self.close_pack()
+        self.prune()
+        self.compact()
+
+        data = {"files": dict([(to_name(key), entry) for key, entry in self.own.items()]), "objects": self.own_objects}
+        temp_path = self.index_path + copier.PART_SUFFIX
+        with open(temp_path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        state.replace_file(temp_path, self.index_path)
+
+        name = index_name(self.machine)
+        mtime = os.stat(self.index_path).st_mtime
+        self.indexes[name] = (mtime, dict(self.own), dict(self.own_objects))
+        if self.loaded is not None:
+            self.loaded = dict(self.loaded)
+            self.loaded[name] = mtime
+        self.dirty = False
+        log.debug("wrote %s with %s files", self.index_path, len(self.own))
+
+        # Old packs can only be removed once the index does not refer to them anymore
+        used = set([value[0] for value in self.own_objects.values()])
+        for pack_name in self.packs - used:
+            try:
+                os.remove(self.pack_path(pack_name))
+            except OSError as e:
+                log.debug("Error while removing %s: %s", pack_name, e)
+        self.packs = used
+
+    def prune(self):
+        # Entries replaced by a newer one of another machine are not needed anymore, a
+        # deleted key only as long as another machine still has an older entry for it
+        others = [files for name, (mtime, files, objects) in self.indexes.items() if name != index_name(self.machine)]
+        for key, entry in list(self.own.items()):
+            if self.entries.get(key) is not entry:
+                del self.own[key]
+            elif entry[0] is None and not any([key in files and files[key][0] is not None for files in others]):
+                del self.own[key]
+        self.merge()
+
+    def compact(self):
+        used = set([entry[2] for entry in self.own.values() if entry[0] is not None])
+        for digest in list(self.own_objects.keys()):
+            if digest not in used:
+                del self.own_objects[digest]
+
+        total = 0
+        for name in self.packs:
+            try:
+                total += os.path.getsize(self.pack_path(name))
+            except OSError:
+                pass
+        live = sum([value[2] for value in self.own_objects.values()])
+        if total < MIN_COMPACT_SIZE or 2 * live > total:
+            self.merge()
+            return
+
+        log.debug("compacting %s, %s of %s bytes used", self.pack_dir, live, total)
+        objects = sorted(self.own_objects.items(), key=lambda item: item[1])
+        for digest, (name, offset, length) in objects:
+            with open(self.pack_path(name), "rb") as f:
+                f.seek(offset)
+                compressed = f.read(length)
+            new_name, new_f = self.open_pack()
+            self.own_objects[digest] = [new_name, new_f.tell(), length]
+            new_f.write(compressed)
+        self.close_pack()
+        self.merge()
@@ -0,0 +1,208 @@
+import sublime
+
+import os
+import shutil
+import sys
+import threading
+
+try:
+    from . import copier
+    from . import logger
+    from . import tools
+except ValueError:
+    from package_syncing import copier
+    from package_syncing import logger
+    from package_syncing import tools
+
+log = logger.getLogger(__name__)
+
+# Milliseconds Sublime Text gets to unload packages after they were ignored
+UNLOAD_DELAY = 1000
+# Package Control removes directories with this file on its next start
+CLEANUP_FILE = "package-control.cleanup"
+
+REMOVED = "removed"
+CLEANUP = "cleanup"
+
+# Never removed, even if it is missing in a pulled Package Control.sublime-settings
+KEEP = set(["Package Control"])
+
+# Packages of all running removals
+removing = set()
+removing_lock = threading.Lock()
+
+
+def remove(packages, callback=None, concurrency=4):
+    # Removes packages without blocking the calling thread, callback is called on the main
+    # thread with {package: REMOVED, CLEANUP or the exception} once all of them are done
+    with removing_lock:
+        packages = [package for package in packages if package not in removing]
+        removing.update(packages)
+
+    if not packages:
+        return False
+
+    Removal(packages, callback, concurrency).start()
+    return True
+
+
+def removed(results):
+    # Packages which could not be removed are tried again with the next change
+    remove_packages = tools.load_last_data().get("remove_packages", [])
+    tools.save_last_data(remove_packages=[package for package in remove_packages if results.get(package) not in [REMOVED, CLEANUP]])
+    tools.flush_last_data(delay=1)
+
+
+def cleanup():
+    # Package Control installs all missing packages during its cleanup
+    try:
+        # Reset last-run file
+        file_path = os.path.join(sublime.packages_path(), "User", "Package Control.last-run")
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+        # Import package_control_cleaner
+        mod = sys.modules["package_control.package_cleanup" if sublime.version()[0] == "2" else "Package Control.package_control.package_cleanup"]
+        package_control_cleaner = mod.PackageCleanup()
+        package_control_cleaner.start()
+    except:
+        print("Package Syncing: Error while loading Package Control")
+
+
+def remove_package(package):
+    # Removes all copies of a package, a directory in use is left to Package Control
+    for path in [os.path.join(sublime.installed_packages_path(), package + ".sublime-package"),
+                 os.path.join(os.path.dirname(sublime.packages_path()), "Pristine Packages", package + ".sublime-package")]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    package_dir = os.path.join(sublime.packages_path(), package)
+    if os.path.isdir(package_dir):
+        try:
+            shutil.rmtree(package_dir)
+        except OSError as e:
+            log.debug("Unable to remove %s: %s", package_dir, e)
+            open(os.path.join(package_dir, CLEANUP_FILE), "w").close()
+            return CLEANUP
+
+    return REMOVED
+
+
+class Removal(object):
+
+    def __init__(self, packages, callback=None, concurrency=4):
+        self.packages = packages
+        self.callback = callback
+        self.concurrency = concurrency
+
+        # Packages ignored by this removal, others were ignored by the user before
+        self.ignored = []
+        self.results = {}
+
+    def start(self):
+        log.debug("removing %s", self.packages)
+        sublime.set_timeout(self.ignore, 0)
+
+    def ignore(self):
+        # Sublime Text unloads ignored packages, so their files can be removed afterwards
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        ignored_packages = settings.get("ignored_packages", [])
+        self.ignored = [package for package in self.packages if package not in ignored_packages]
+        settings.set("ignored_packages", ignored_packages + self.ignored)
+        sublime.save_settings("Preferences.sublime-settings")
+
+        sublime.set_timeout(lambda: threading.Thread(target=self.remove, name="Package Syncing Removal").start(), UNLOAD_DELAY)
+
+    def remove(self):
+        for package, result, error in copier.run(remove_package, self.packages, self.concurrency):
+            self.results[package] = error or result
+
+        sublime.set_timeout(self.unignore, 0)
+
+    def unignore(self):
+        settings = sublime.load_settings("Preferences.sublime-settings")
+        ignored_packages = settings.get("ignored_packages", [])
+        settings.set("ignored_packages", [package for package in ignored_packages if package not in self.ignored])
+        sublime.save_settings("Preferences.sublime-settings")
+
+        with removing_lock:
+            removing.difference_update(self.packages)
+
+        for package in self.packages:
+            result = self.results.get(package)
+            if result == REMOVED:
+                print("Package Syncing: Removed package %s" % package)
+            elif result == CLEANUP:
+                print("Package Syncing: Package %s is removed by Package Control on the next start" % package)
+            else:
+                print("Package Syncing: Error while removing package %s: %s" % (package, result))
+
+        if self.callback:
+            self.callback(self.results)
+
+
+class Reconciler(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timer = None
+
+        # Installed packages before the first and after the last change of a batch
+        self.before = None
+        self.after = None
+
+    def update(self, previous, installed, delay=5):
+        with self.lock:
+            if self.before is None:
+                self.before = set(previous)
+            self.after = set(installed)
+
+            # Wait for further revisions, the timer is restarted with every change
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def take(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            before, after = self.before, self.after
+            self.before, self.after, self.timer = None, None, None
+        return before, after
+
+    def remove_packages(self, before, after):
+        # Removals of this batch together with the ones which failed before, unless they are wanted again
+        remove_packages = set(tools.load_last_data().get("remove_packages", [])) | (before - after)
+        return sorted(remove_packages - after - KEEP)
+
+    def flush(self):
+        before, after = self.take()
+        if before is None:
+            return
+
+        to_install = after - before
+        remove_packages = self.remove_packages(before, after)
+        log.debug("install: %s", sorted(to_install))
+        log.debug("remove: %s", remove_packages)
+
+        # Packages are kept in the last-run data until they are gone
+        tools.save_last_data(remove_packages=remove_packages)
+        tools.flush_last_data(delay=1)
+        if remove_packages:
+            remove(remove_packages, removed)
+
+        # One cleanup installs all new packages of the batch
+        if to_install:
+            sublime.set_timeout(cleanup, 0)
+
+    def stop(self):
+        # Keep the removals of a pending batch for the next start, Package Control installs
+        # missing packages on its own
+        before, after = self.take()
+        if before is not None:
+            tools.save_last_data(remove_packages=self.remove_packages(before, after))
+
+
+reconciler = Reconciler()
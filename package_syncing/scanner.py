@@ -0,0 +1,149 @@
+import os
+import sys
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+try:
+    from . import logger
+    from . import stats
+except ValueError:
+    from package_syncing import logger
+    from package_syncing import stats
+
+log = logger.getLogger(__name__)
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # Python 2 can only intern byte strings, the paths of Sublime Text 2 are unicode
+    def intern(string):
+        return string
+
+# Directories changed within this window are listed again on the next pass,
+# since a second change could happen within the mtime resolution
+RACY_INTERVAL = 2
+
+scanners = {}
+scanners_lock = threading.Lock()
+
+
+def get_scanner(folder, matcher):
+    key = (folder, matcher.key)
+    with scanners_lock:
+        if key not in scanners:
+            scanners[key] = Scanner(folder, matcher)
+        return scanners[key]
+
+
+def list_entries(path):
+    # Returns the names of the sub directories and files, symlinked dirs are skipped like in os.walk
+    dir_names, file_names = [], []
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dir_names += [entry.name]
+            elif entry.is_file():
+                file_names += [entry.name]
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                dir_names += [name]
+            elif os.path.isfile(full_path):
+                file_names += [name]
+    return dir_names, file_names
+
+
+class Scanner(object):
+
+    def __init__(self, folder, matcher):
+        self.folder = folder
+        self.matcher = matcher
+
+        # Relative dir path -> (mtime, dir_names, matching file_names)
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def listdir(self, rel_dir):
+        path = os.path.join(self.folder, rel_dir) if rel_dir else self.folder
+        try:
+            dir_mtime = os.stat(path).st_mtime
+        except OSError:
+            self.dirs.pop(rel_dir, None)
+            return [], []
+
+        cached = self.dirs.get(rel_dir)
+        if cached and cached[0] == dir_mtime:
+            return cached[1], cached[2]
+
+        log.trace("listing %s", path)
+        stats.collector.incr("dirs listed")
+        try:
+            dir_names, file_names = list_entries(path)
+        except OSError:
+            self.dirs.pop(rel_dir, None)
+            return [], []
+
+        dir_names = [d for d in dir_names if not self.matcher.ignore_dir(d)]
+        file_names = [f for f in file_names if self.matcher.match(os.path.join(rel_dir, f))]
+
+        # Do not trust a listing which could be changed again within the same mtime
+        if time.time() - dir_mtime > RACY_INTERVAL:
+            self.dirs[rel_dir] = (dir_mtime, dir_names, file_names)
+        else:
+            self.dirs.pop(rel_dir, None)
+
+        return dir_names, file_names
+
+    def walk(self):
+        # Yields (key, version) of every matching file, only one directory is held in memory
+        seen_dirs = set()
+        count = 0
+
+        with self.lock:
+            pending = [""]
+            while pending:
+                rel_dir = pending.pop()
+                seen_dirs.add(rel_dir)
+
+                dir_names, file_names = self.listdir(rel_dir)
+                pending += [os.path.join(rel_dir, d) for d in dir_names]
+
+                for file_name in file_names:
+                    rel_path = os.path.join(rel_dir, file_name)
+                    try:
+                        version = os.stat(os.path.join(self.folder, rel_path)).st_mtime
+                    except OSError:
+                        continue
+                    count += 1
+                    # The same keys are kept for both folders and the last-run data
+                    yield intern(rel_path), version
+
+            stats.collector.incr("files stat'ed", count)
+
+            # Forget directories which are gone
+            for rel_dir in list(self.dirs.keys()):
+                if rel_dir not in seen_dirs:
+                    del self.dirs[rel_dir]
+
+    def scan(self):
+        # Key -> version of all matching files
+        return dict(self.walk())
+
+    def dump(self):
+        # Directory listings to be restored by the next start
+        with self.lock:
+            return dict([(rel_dir, list(entry)) for rel_dir, entry in self.dirs.items()])
+
+    def restore(self, dirs):
+        # Restored listings are only used as long as the directory mtime is unchanged
+        with self.lock:
+            for rel_dir, entry in dirs.items():
+                if rel_dir not in self.dirs:
+                    self.dirs[rel_dir] = tuple(entry)
+        log.debug("restored %s listings of %s", len(dirs), self.folder)
@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+
+try:
+    from . import logger
+    from . import scanner
+except ValueError:
+    from package_syncing import logger
+    from package_syncing import scanner
+
+log = logger.getLogger(__name__)
+
+# Writes of the sync are only recognized by the watchers within this many seconds
+ECHO_TIMEOUT = 60
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_index(folder, matcher, store=None):
+    key = (folder, matcher.key, store is not None)
+    with indexes_lock:
+        if key not in indexes:
+            indexes[key] = Index(folder, matcher, store)
+        return indexes[key]
+
+
+def make_item(folder, key, version=None, item_type=None):
+    # Item format of the watchers and commands, only built for files which are synced
+    item = {"key": key, "path": os.path.join(folder, key), "dir": os.path.dirname(key)}
+    if version is not None:
+        item["version"] = version
+    if item_type:
+        item["type"] = item_type
+    return item
+
+
+def get_snapshot(local_dir, remote_dir, matcher, store=None, local_matcher=None):
+    # With a pack store the remote files are read from its index instead of the folder.
+    # The local folder is shared by all profiles and scanned with local_matcher
+    local = get_index(local_dir, local_matcher or matcher)
+    if local.matcher is not matcher:
+        local = View(local, matcher)
+    return Snapshot(local, get_index(remote_dir, matcher, store))
+
+
+def key_data(key):
+    # Matcher keys as stored in JSON
+    return [key_data(part) if isinstance(part, tuple) else part for part in key]
+
+
+class Index(object):
+
+    def __init__(self, folder, matcher, store=None):
+        self.folder = folder
+        self.matcher = matcher
+        self.store = store
+        self.scanner = scanner.get_scanner(folder, matcher) if not store else None
+
+        # Key -> version, paths are derived from the folder when needed
+        self.files = {}
+        self.scanned = None
+        # Incremented whenever a file is added, changed or removed
+        self.generation = 0
+        # Key -> (version, size, time) of files written by the sync, None for deleted files
+        self.echoes = {}
+        # Expired echoes are dropped once the registry grows beyond this size
+        self.echo_limit = 256
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        files = self.store.scan(self.matcher) if self.store else dict(self.scanner.walk())
+        with self.lock:
+            if files != self.files:
+                self.generation += 1
+            self.files = files
+            self.scanned = time.time()
+        log.debug("refreshed %s with %s files", self.folder, len(files))
+        return self.data()
+
+    def data(self):
+        # Copy of the current state, safe to iterate while the index changes
+        with self.lock:
+            return dict(self.files)
+
+    def get(self, key):
+        with self.lock:
+            return self.files.get(key)
+
+    def path(self, key):
+        return os.path.join(self.folder, key)
+
+    def update(self, key):
+        # Returns the current version of key, None if it is gone
+        if self.store:
+            version = self.store.version(key)
+        else:
+            try:
+                version = os.stat(self.path(key)).st_mtime
+            except OSError:
+                version = None
+
+        if version is None:
+            return self.remove(key)
+        return self.set(key, version)
+
+    def dump(self):
+        # Listings depend on the matcher, so it is stored along with them
+        return {"matcher": key_data(self.matcher.key), "dirs": self.scanner.dump() if self.scanner else {}}
+
+    def restore(self, data):
+        # A pack store reads its index instead of listing directories
+        if self.scanner and data and data.get("matcher") == key_data(self.matcher.key):
+            self.scanner.restore(data.get("dirs", {}))
+
+    def stat(self, key):
+        # (version, size) of key, None if it is gone
+        if self.store:
+            version = self.store.version(key)
+            return (version, self.store.size(key)) if version is not None else None
+        try:
+            st = os.stat(self.path(key))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def expect(self, key, st=None):
+        # Called before the sync writes key with the (version, size) st or deletes it,
+        # the watchers drop the resulting event instead of syncing the file back
+        now = time.time()
+        with self.lock:
+            if len(self.echoes) > self.echo_limit:
+                self.echoes = dict([(k, v) for k, v in self.echoes.items() if now - v[2] < ECHO_TIMEOUT])
+                # A large sync expects many files at once, pruning on every call would be quadratic
+                self.echo_limit = max(256, 2 * len(self.echoes))
+            self.echoes[key] = (st[0], st[1], now) if st else (None, None, now)
+
+    def is_echo(self, key, version=None):
+        # Whether a change seen by a watcher was made by the sync, version is None for deletions.
+        # Other changes keep the entry, the watcher might have seen a write in progress
+        with self.lock:
+            echo = self.echoes.get(key)
+            if not echo or echo[0] != version:
+                return False
+            del self.echoes[key]
+
+        if time.time() - echo[2] > ECHO_TIMEOUT:
+            return False
+        if version is None:
+            return True
+
+        # Same mtime, but a different size is a change made right after the sync
+        return self.stat(key) == (echo[0], echo[1])
+
+    def set(self, key, version):
+        with self.lock:
+            if self.files.get(key) != version:
+                self.generation += 1
+            self.files[key] = version
+        return version
+
+    def remove(self, key):
+        with self.lock:
+            if self.files.pop(key, None) is not None:
+                self.generation += 1
+
+
+class Snapshot(object):
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+
+    def refresh(self, local=True, remote=True):
+        if local:
+            self.local.refresh()
+        if remote:
+            self.remote.refresh()
+
+    def generation(self):
+        return (self.local.generation, self.remote.generation)
+
+    def dump(self):
+        return dict([(index.folder, index.dump()) for index in [self.local, self.remote]])
+
+    def restore(self, data):
+        for index in [self.local, self.remote]:
+            index.restore((data or {}).get(index.folder))
+
+
+class View(object):
+
+    def __init__(self, index, matcher):
+        # Files of a shared index which match the narrower matcher of a profile,
+        # everything else is passed on to the index
+        self.index = index
+        self.matcher = matcher
+        self.cached = (None, {})
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    @property
+    def files(self):
+        return self.data()
+
+    def refresh(self):
+        self.index.refresh()
+        return self.data()
+
+    def data(self):
+        # Filtered once per generation of the index
+        generation, files = self.cached
+        if generation != self.index.generation:
+            with self.index.lock:
+                generation = self.index.generation
+                files = dict([(key, version) for key, version in self.index.files.items() if self.matcher.match_path(key)])
+            self.cached = (generation, files)
+        return dict(files)
+
+    def get(self, key):
+        return self.index.get(key) if self.matcher.match_path(key) else None
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+try:
+    from . import logger
+except ValueError:
+    from package_syncing import logger
+
+log = logger.getLogger(__name__)
+
+
+def replace_file(source, target):
+    try:
+        os.replace(source, target)
+    except AttributeError:
+        # os.replace is not available before Python 3.3
+        if os.name == "nt" and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+def short_path(path, folders):
+    # Path relative to one of the (name, folder) pairs, keeps absolute paths out of state files
+    for name, folder in folders:
+        if path.startswith(folder + os.sep):
+            return "%s:%s" % (name, path[len(folder) + 1:])
+    return path
+
+
+def copy_data(data):
+    # Sync threads change nested dicts of the state in place without the lock. Copying a
+    # single dict or list does not switch threads, so the copy is never changed while it
+    # is serialized
+    if isinstance(data, dict):
+        return dict([(key, copy_data(value)) for key, value in list(data.items())])
+    if isinstance(data, list):
+        return [copy_data(value) for value in list(data)]
+    return data
+
+
+class State(object):
+
+    def __init__(self, path):
+        self.path = path
+
+        self.data = None
+        self.dirty = False
+        # Incremented on every change, tells whether the data changed since it was used
+        self.generation = 0
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.path, "r") as f:
+                        self.data = json.load(f)
+                except Exception:
+                    self.data = {}
+            return self.data
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def update(self, **kwargs):
+        with self.lock:
+            self.load().update(kwargs)
+            self.dirty = True
+            self.generation += 1
+
+    def reset(self):
+        with self.lock:
+            self.cancel()
+            self.data = {}
+            self.dirty = False
+            self.generation += 1
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def flush(self, delay=0):
+        with self.lock:
+            self.cancel()
+
+            # Wait for further changes, the last call within the window writes the file
+            if delay:
+                self.timer = threading.Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+
+            if not self.dirty:
+                return
+
+            # Write to a temporary file first, a crash can not leave a truncated file behind
+            temp_path = self.path + ".tmp"
+            try:
+                data = copy_data(self.data)
+                with open(temp_path, "w") as f:
+                    json.dump(data, f, sort_keys=True, separators=(",", ":"))
+                replace_file(temp_path, self.path)
+                self.dirty = False
+                log.debug("saved %s", self.path)
+            except Exception as e:
+                log.warning("Error while saving %s %s", os.path.basename(self.path), e)
+                print("Package Syncing: Error while saving %s: %s" % (os.path.basename(self.path), e))
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
@@ -0,0 +1,112 @@
+import collections
+import json
+import threading
+import time
+
+try:
+    from . import logger
+    from . import state
+except ValueError:
+    from package_syncing import logger
+    from package_syncing import state
+
+log = logger.getLogger(__name__)
+
+
+class Timer(object):
+
+    def __init__(self, stats, phase, record=None):
+        self.stats = stats
+        self.phase = phase
+        self.record = record
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.time() - self.start
+        self.stats.add_timing(self.phase, duration)
+        if self.record is not None:
+            self.record[self.phase] = self.record.get(self.phase, 0) + duration
+
+
+class Stats(object):
+
+    def __init__(self, history=20):
+        self.lock = threading.Lock()
+        self.reset(history)
+
+    def reset(self, history=20):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            # Phase -> [count, total, max, last]
+            self.timings = {}
+            self.syncs = collections.deque(maxlen=history)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_timing(self, phase, duration):
+        with self.lock:
+            timing = self.timings.setdefault(phase, [0, 0.0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+            timing[3] = duration
+
+    def timer(self, phase, record=None):
+        return Timer(self, phase, record)
+
+    def add_sync(self, record):
+        with self.lock:
+            self.syncs.append(record)
+
+    def report(self):
+        with self.lock:
+            timings = {}
+            for phase, (count, total, maximum, last) in self.timings.items():
+                timings[phase] = {"count": count, "total": total, "avg": total / count, "max": maximum, "last": last}
+            return {"since": self.started, "counters": dict(self.counters), "timings": timings, "syncs": list(self.syncs)}
+
+    def format(self):
+        report = self.report()
+        lines = ["Package Syncing statistics since %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(report["since"])), ""]
+
+        lines += ["%-24s %8s %10s %10s %10s" % ("Phase", "Count", "Avg ms", "Max ms", "Total ms")]
+        for phase in sorted(report["timings"]):
+            t = report["timings"][phase]
+            lines += ["%-24s %8d %10.1f %10.1f %10.1f" % (phase, t["count"], t["avg"] * 1000, t["max"] * 1000, t["total"] * 1000)]
+
+        lines += ["", "%-24s %8s" % ("Counter", "Value")]
+        for name in sorted(report["counters"]):
+            lines += ["%-24s %8d" % (name, report["counters"][name])]
+
+        lines += ["", "Recent syncs"]
+        for record in report["syncs"]:
+            phases = ", ".join(["%s %.1f ms" % (phase, duration * 1000) for phase, duration in sorted(record["timings"].items())])
+            lines += ["%s %-12s %s" % (time.strftime("%H:%M:%S", time.localtime(record["time"])), record["mode"], phases)]
+
+        return "\n".join(lines)
+
+    def write_metrics(self, path, record, limit=100):
+        # Append the record to a rolling JSON file for offline analysis
+        try:
+            with open(path, "r") as f:
+                records = json.load(f)
+        except Exception:
+            records = []
+
+        records = (records + [record])[-limit:]
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(records, f)
+            state.replace_file(temp_path, path)
+        except Exception as e:
+            log.warning("Error while writing metrics %s %s", path, e)
+
+
+collector = Stats()
@@ -1,81 +1,217 @@
 import sublime
 import sublime_plugin
 
-import fnmatch
+import collections
 import functools
+import itertools
 import os
-import shutil
-import sys
 import threading
 import time
+import traceback
 
 try:
+    from . import copier
+    from . import delta
+    from . import diff
+    from . import fingerprint
     from . import logger
+    from . import pack
+    from . import packages
+    from . import snapshot
+    from . import stats
     from . import tools
     from . import watcher
 except ValueError:
+    from package_syncing import copier
+    from package_syncing import delta
+    from package_syncing import diff
+    from package_syncing import fingerprint
     from package_syncing import logger
+    from package_syncing import pack
+    from package_syncing import packages
+    from package_syncing import snapshot
+    from package_syncing import stats
     from package_syncing import tools
     from package_syncing import watcher
 
 log = logger.getLogger(__name__)
 
+# Profile name -> plan of the last dry run, see SyncPlan
+last_plans = {}
 
-class Queue(object):
 
-    current = None
-    pool = []
+class Queue(object):
 
     def __init__(self):
-        pass
+        self.jobs = collections.deque()
+        self.pending = set()
+        self.current = None
+        self.stopped = False
 
-    def start(self):
-        # Clear old thread
-        if self.current and self.current["thread"].is_alive():
-            sublime.set_timeout(lambda: self.start(), 500)
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.worker = None
 
-        else:
-            # Reset current thread, since it ended
-            self.current = None
+    def start(self):
+        with self.condition:
+            if self.worker and self.worker.is_alive():
+                return
+            self.stopped = False
+            self.worker = threading.Thread(target=self.work, name="Package Syncing Queue")
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.jobs.clear()
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key, job, queued = self.jobs.popleft()
+                self.pending.discard(key)
+                self.current = key
 
-            # Check for elements in pool
-            if self.pool:
-                self.current = self.pool.pop(0)
-                self.current["thread"].start()
+            stats.collector.add_timing("queue wait", time.time() - queued)
 
-                # Attemp a new start of the thread
-                sublime.set_timeout(lambda: self.start(), 500)
+            try:
+                job.run()
+            except Exception as e:
+                print("Package Syncing: Error while syncing %s" % e)
+                traceback.print_exc()
+            finally:
+                # Report the job as done right away, no polling involved
+                with self.condition:
+                    self.current = None
+                    self.condition.notify_all()
 
     def has(self, key):
-        pool = self.pool + [self.current] if self.current else []
-        return any([item for item in pool if item["key"] == key])
+        with self.condition:
+            return key in self.pending or key == self.current
+
+    def add(self, job, key=None):
+        key = key if key else "job-%s" % next(self.counter)
+        with self.condition:
+            # Skip jobs which are already waiting, a running job does not block a new one
+            if key in self.pending:
+                log.debug("%s already queued", key)
+                return False
+            self.pending.add(key)
+            self.jobs.append((key, job, time.time()))
+            self.condition.notify_all()
 
-    def add(self, thread, key=None):
-        self.pool += [{"key": key if key else thread.name, "thread": thread}]
         self.start()
+        return True
+
+    def join(self, timeout=None):
+        # Wait until all queued jobs are done, returns False on timeout
+        end = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.jobs or self.current is not None:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class SyncPlan(object):
+
+    def __init__(self, settings, mode, override, snapshot, plans):
+        # Result of a dry run, which can be applied later without a rescan
+        self.mode = mode
+        self.override = override
+        self.plans = plans
+        self.profile = settings.get("profile", "")
+        self.created = time.time()
+        self.scanned = (len(snapshot.local.files), len(snapshot.remote.files))
+        self.state = SyncPlan.get_state(settings, snapshot)
+
+    @staticmethod
+    def get_state(settings, snapshot):
+        # Anything a plan depends on, the watchers keep the snapshot up to date
+        profile = settings.get("profile", "")
+        return (profile, settings.get("sync_folder"), settings.get("remote_format", "files"), tools.load_matcher(settings).key, snapshot.generation(), tools.get_last_run(profile).generation)
 
+    def is_valid(self, settings, snapshot):
+        return self.state == SyncPlan.get_state(settings, snapshot)
 
-class Sync(threading.Thread):
+    def format(self):
+        lines = ["Package Syncing plan for %s%s%s, created %s" % ("+".join(self.mode), " of profile %s" % self.profile if self.profile else "", " with override" if self.override else "", time.strftime("%H:%M:%S", time.localtime(self.created)))]
+        lines += ["Scanned %d local and %d remote files" % self.scanned, ""]
+        for plan in self.plans:
+            lines += plan.format() + [""]
+        lines += ["Run \"Package Syncing: Apply Sync Plan\" to apply it, the folders are scanned again if anything changed meanwhile."]
+        return "\n".join(lines)
 
-    def __init__(self, settings, mode=["pull", "push"], override=False, item=None):
+
+class Sync(object):
+
+    def __init__(self, settings, mode=["pull", "push"], override=False, item=None, items=None, dry_run=False, cached_plan=None, startup=False, scan_local=True):
 
         self.settings = settings
+        self.profile = settings.get("profile", "")
         self.mode = mode
-        self.item = item
+        self.items = items or ([item] if item else [])
         self.override = override
 
-        threading.Thread.__init__(self)
+        # Only show the changes of a complete sync, or apply the changes of a previous dry run
+        self.dry_run = dry_run
+        self.cached_plan = cached_plan
+        self.plans = {}
+        # Start the watchers after the first scan and skip the sync if nothing changed
+        self.startup = startup
+        # The local folder is shared by all profiles, syncs of several profiles in a row scan it once
+        self.scan_local = scan_local
+
+        # Timings and counters of this sync only
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def timer(self, phase):
+        return stats.collector.timer(phase, self.timings)
+
+    def count(self, name, value=1):
+        stats.collector.incr(name, value)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
 
     def run(self):
         sync_interval = self.settings.get("sync_interval", 1)
+        start = time.time()
+
+        local_dir = os.path.join(sublime.packages_path(), "User")
+        remote_dir = self.settings.get("sync_folder")
+        self.store = tools.load_store(self.settings)
+        self.snapshot = snapshot.get_snapshot(local_dir, remote_dir, tools.load_matcher(self.settings), self.store, tools.load_local_matcher(tools.load_settings()))
 
         # Stop watcher and wait for the poll
-        tools.pause_watcher(local="pull" in self.mode, remote="push" in self.mode)
+        tools.pause_watcher(local="pull" in self.mode, remote="push" in self.mode, profile=self.profile)
 
         # If no item pull and push all
-        if not self.item:
+        if self.dry_run:
+            self.scan()
+            self.show_plan()
+        elif self.startup:
+            self.start()
+        elif not self.items:
             print("Package Syncing: Start Complete Sync")
 
+            # Nothing changed since the dry run, its plan is still up to date
+            if self.cached_plan and self.cached_plan.is_valid(self.settings, self.snapshot):
+                print("Package Syncing: Apply Sync Plan")
+                self.plans = dict([(plan.direction, plan) for plan in self.cached_plan.plans])
+            else:
+                self.scan()
+
             # Fetch all items from the remote location
             if "pull" in self.mode:
                 self.pull_all()
@@ -85,92 +221,303 @@ class Sync(threading.Thread):
                 self.push_all()
 
             print("Package Syncing: End Complete Sync")
+            tools.save_last_data(self.profile, snapshot=self.snapshot.dump())
         else:
-            # Pull the selected item
-            if "pull" in self.mode:
-                self.pull(self.item)
+            # Items pushed in a row end up in the same pack
+            with self.timer("copy"):
+                with pack.Batch(self.store):
+                    for item in self.items:
+                        # Pull the selected item
+                        if "pull" in self.mode:
+                            self.pull(item)
 
-            # Push the selected item
-            if "push" in self.mode:
-                self.push(self.item)
+                        # Push the selected item
+                        if "push" in self.mode:
+                            self.push(item)
+
+        # Write the last-run data once per sync, item syncs in a row are written together
+        with self.timer("state persist"):
+            tools.flush_last_data(1 if self.items else 0, self.profile)
+
+        self.save_stats(time.time() - start)
 
         # Restart watcher again
-        tools.pause_watcher(False, local="pull" in self.mode, remote="push" in self.mode)
+        tools.pause_watcher(False, local="pull" in self.mode, remote="push" in self.mode, profile=self.profile)
 
-    def find_files(self, path):
-        log.debug("find_files started for %s", path)
+    def start(self):
+        # Directory listings of the last run spare listing unchanged directories again
+        self.snapshot.restore(tools.load_last_data(self.profile).get("snapshot"))
+        self.scan()
 
-        files_to_include = self.settings.get("files_to_include", [])
-        files_to_ignore = self.settings.get("files_to_ignore", []) + ["Package Syncing.sublime-settings", "Package Syncing.last-run"]
-        dirs_to_ignore = self.settings.get("dirs_to_ignore", [])
+        # The watchers take their files from the snapshot instead of scanning again
+        tools.start_watcher(tools.load_settings(), local=self.scan_local, profile=self.profile)
 
-        log.debug("path %s" % path)
-        log.debug("files_to_include %s" % files_to_include)
-        log.debug("files_to_ignore %s" % files_to_ignore)
-        log.debug("dirs_to_ignore %s" % dirs_to_ignore)
+        for direction in [diff.PULL, diff.PUSH]:
+            if direction in self.mode:
+                self.plans[direction] = self.plan(direction)
 
-        resources = {}
-        for root, dir_names, file_names in os.walk(path):
-            [dir_names.remove(dir) for dir in dir_names if dir in dirs_to_ignore]
+        if not any([len(plan) for plan in self.plans.values()]):
+            print("Package Syncing: Nothing changed since the last sync")
+            self.plans = {}
+        else:
+            print("Package Syncing: Start Complete Sync")
+            if "pull" in self.mode:
+                self.pull_all()
+            if "push" in self.mode:
+                self.push_all()
+            print("Package Syncing: End Complete Sync")
 
-            for file_name in file_names:
-                full_path = os.path.join(root, file_name)
-                rel_path = os.path.relpath(full_path, path)
+        tools.save_last_data(self.profile, snapshot=self.snapshot.dump())
+
+    def scan(self):
+        # Scan both folders once, the copies keep the snapshot up to date
+        # An unscanned local folder would look as if all files were deleted
+        if self.scan_local or not self.snapshot.local.scanned:
+            with self.timer("scan local"):
+                self.snapshot.local.refresh()
+        with self.timer("scan remote"):
+            self.snapshot.remote.refresh()
+
+    def show_plan(self):
+        last_data = tools.load_last_data(self.profile)
+        local_data = self.snapshot.local.data()
+        remote_data = self.snapshot.remote.data()
+        last_local_data = last_data.get("last_local_data", {})
+        last_remote_data = last_data.get("last_remote_data", {})
 
-                include_matches = [fnmatch.fnmatch(rel_path, p) for p in files_to_include]
-                ignore_matches = [fnmatch.fnmatch(rel_path, p) for p in files_to_ignore]
-                if any(ignore_matches) or not any(include_matches):
+        plans = []
+        with self.timer("diff"):
+            for direction in [diff.PULL, diff.PUSH]:
+                if direction not in self.mode:
                     continue
+                plan = diff.compute(direction, local_data, remote_data, last_local_data, last_remote_data, self.override)
+                self.measure(plan)
+                plans += [plan]
+
+                # The push of a complete sync is based on the state right after the pull
+                if direction == diff.PULL:
+                    local_data = diff.applied(plan, local_data)
+                    last_local_data, last_remote_data = local_data, remote_data
+
+        last_plans[self.profile] = SyncPlan(self.settings, self.mode, self.override, self.snapshot, plans)
+        text = "\n\n".join([last_plans[profile].format() for profile in sorted(last_plans.keys())])
+        sublime.set_timeout(lambda: tools.show_panel(sublime.active_window(), "package_syncing_plan", text), 0)
+
+    def folder(self, direction):
+        # Source folder of a direction
+        return self.snapshot.remote.folder if direction == diff.PULL else self.snapshot.local.folder
+
+    def measure(self, plan):
+        # Bytes to copy for every created or updated file
+        for change in plan.changes:
+            if change.type == "d":
+                continue
+            try:
+                if self.store and plan.direction == diff.PULL:
+                    plan.sizes[change.key] = self.store.size(change.key) or 0
+                else:
+                    plan.sizes[change.key] = os.path.getsize(os.path.join(self.folder(plan.direction), change.key))
+            except OSError:
+                pass
 
-                resources[rel_path] = {"version": os.path.getmtime(full_path), "path": full_path, "dir": os.path.dirname(rel_path)}
+    def save_stats(self, duration):
+        self.timings["total"] = duration
+        record = {"time": time.time(), "mode": "+".join(self.mode) + (" plan" if self.dry_run else ""), "items": len(self.items), "timings": self.timings, "counters": self.counters}
+        stats.collector.add_sync(record)
+
+        metrics_file = self.settings.get("metrics_file")
+        if metrics_file:
+            metrics_file = os.path.join(sublime.packages_path(), "User", os.path.expanduser(metrics_file))
+            stats.collector.write_metrics(metrics_file, record, self.settings.get("metrics_limit", 100))
+
+    def cache_folders(self):
+        # Cached file data is stored relative to these folders
+        return (("local", self.snapshot.local.folder), ("remote", self.snapshot.remote.folder))
+
+    def fingerprints(self):
+        return fingerprint.Fingerprints(tools.load_last_data(self.profile).setdefault("fingerprints", {}), self.cache_folders())
+
+    def copy_file(self, source, target):
+        # Skip the copy if the target has already the same content
+        if self.settings.get("compare_content", True) and self.fingerprints().same_content(source, target):
+            # The target takes the version of the source, otherwise every sync plans the same change
+            st = os.stat(source)
+            os.utime(target, (st.st_atime, st.st_mtime))
+            self.count("files skipped")
+            return False
 
-        return resources
+        # Try to write only the changed blocks of a modified file
+        if self.settings.get("delta_transfer", False):
+            written = self.patch_file(source, target)
+            if written is not None:
+                self.count("files patched")
+                self.count("bytes copied", written)
+                return True
+
+        block_size = self.settings.get("delta_block_size", delta.BLOCK_SIZE)
+        chunk_size = self.settings.get("copy_chunk_size", copier.CHUNK_SIZE)
+        blocks = None
+        if self.settings.get("delta_transfer", False):
+            # Collect the block digests while copying, the chunks have to be aligned to the blocks
+            chunk_size = max(block_size, chunk_size - chunk_size % block_size)
+            blocks = []
+
+        copied = copier.copy_file(source, target, chunk_size, functools.partial(self.progress, target, chunk_size), blocks, block_size)
+        if blocks is not None:
+            self.signatures().set(target, blocks)
+
+        self.count("files copied")
+        self.count("bytes copied", copied)
+        return True
 
-    def pull_all(self):
-        log.debug("pull_all started with override = %s" % self.override)
+    def pull_file(self, item, target):
+        # Copies keep the version and size of the source
+        self.snapshot.local.expect(item["key"], self.snapshot.remote.stat(item["key"]))
+        if not self.store:
+            return self.copy_file(item["path"], target)
 
-        local_dir = os.path.join(sublime.packages_path(), "User")
-        remote_dir = self.settings.get("sync_folder")
+        # Skip the extraction if the local file has already the same content
+        if self.settings.get("compare_content", True) and os.path.isfile(target):
+            try:
+                if self.fingerprints().get(target) == self.store.hash(item["key"]):
+                    version = self.store.version(item["key"])
+                    os.utime(target, (version, version))
+                    self.count("files skipped")
+                    return False
+            except (IOError, OSError):
+                pass
 
-        local_data = self.find_files(local_dir)
-        remote_data = self.find_files(remote_dir)
+        self.count("files copied")
+        self.count("bytes copied", self.store.extract(item["key"], target))
+        return True
 
-        # Get data of last sync
-        last_data = tools.load_last_data()
-        last_local_data = last_data.get("last_local_data", {})
-        last_remote_data = last_data.get("last_remote_data", {})
+    def push_file(self, item, target):
+        self.snapshot.remote.expect(item["key"], self.snapshot.local.stat(item["key"]))
+        if not self.store:
+            return self.copy_file(item["path"], target)
 
-        deleted_local_data = [key for key in last_local_data if key not in local_data]
-        deleted_remote_data = [key for key in last_remote_data if key not in remote_data]
+        # Unchanged content only updates the version in the index
+        written = self.store.add(item["key"], item["path"])
+        self.count("files copied" if written else "files skipped")
+        self.count("bytes copied", written)
+        return written > 0
 
-        log.debug("local_data: %s" % local_data)
-        log.debug("remote_data: %s" % remote_data)
-        log.debug("deleted_local_data: %s" % deleted_local_data)
-        log.debug("deleted_remote_data: %s" % deleted_remote_data)
+    def signatures(self):
+        return delta.Signatures(tools.load_last_data(self.profile).setdefault("signatures", {}), self.settings.get("delta_block_size", delta.BLOCK_SIZE), self.cache_folders())
 
-        diff = [{"type": "d", "key": key} for key in last_remote_data if key not in remote_data]
-        for key, value in remote_data.items():
-            if key in deleted_local_data:
+    def patch_file(self, source, target):
+        signatures = self.signatures()
+        target_blocks = signatures.get(target)
+        if not target_blocks:
+            return None
+
+        try:
+            result = delta.patch(source, target, target_blocks, signatures.block_size)
+        except (IOError, OSError) as e:
+            log.warning("Error while patching %s: %s", target, e)
+            return None
+        if not result:
+            return None
+
+        written, source_blocks = result
+        signatures.set(target, source_blocks)
+        return written
+
+    def progress(self, target, chunk_size, copied, size):
+        # Only files with several chunks are worth a status message
+        if size > 4 * chunk_size:
+            message = "Package Syncing: Copying %s %d%%" % (os.path.basename(target), 100 * copied / size)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+    def make_dirs(self, items, target_dir):
+        # Create all directories up front, so the workers only copy files
+        dirs = set([os.path.dirname(os.path.join(target_dir, item["key"])) for item in items])
+        for path in sorted(dirs):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def copy_items(self, items, target_dir, index, copy_file):
+        def copy(item):
+            # Skipped files got the version of the source as well
+            copied = copy_file(item, os.path.join(target_dir, item["key"]))
+            index.update(item["key"])
+            return copied
+
+        # Partial copies of older or deleted sources are removed once per directory,
+        # the ones of the current sources are kept to resume them
+        keep = set()
+        for item in items:
+            try:
+                keep.add(copier.part_path(os.path.join(target_dir, item["key"]), os.stat(item["path"])))
+            except OSError:
                 pass
-            elif key not in local_data:
-                diff += [dict({"type": "c", "key": key}, **value)]
-            elif int(value["version"]) > int(local_data[key]["version"]) or self.override:
-                diff += [dict({"type": "m", "key": key}, **value)]
+        for folder in set(os.path.dirname(os.path.join(target_dir, item["key"])) for item in items):
+            copier.remove_parts(folder, keep=keep)
+
+        with self.timer("copy"):
+            results = copier.run(copy, items, self.settings.get("copy_concurrency", 4))
+
+        for item, copied, error in results:
+            target = os.path.join(target_dir, item["key"])
+            if error:
+                log.warning("Error while copying %s: %s", target, error)
+                print("Package Syncing: Error while copying %s: %s" % (target, error))
+            elif copied:
+                action = "Created" if item["type"] == "c" else "Updated"
+                log.info("%s %s", action, target)
+                if not log.isEnabledFor(logger.logging.INFO):
+                    print("Package Syncing: %s %s" % (action, target))
+            else:
+                log.debug("Unchanged %s", target)
+
+        return results
+
+    def plan(self, direction):
+        # Changes of a complete sync in one direction, based on the current snapshot
+        if direction in self.plans:
+            return self.plans.pop(direction)
+
+        last_data = tools.load_last_data(self.profile)
+        with self.timer("diff"):
+            plan = diff.compute(direction, self.snapshot.local.data(), self.snapshot.remote.data(), last_data.get("last_local_data", {}), last_data.get("last_remote_data", {}), self.override)
+
+        log.debug("%s plan: %s", direction, plan)
+        if plan.conflicts:
+            log.info("Changed on both sides, the newer version wins: %s", plan.conflicts)
+        return plan
+
+    def pull_all(self):
+        log.debug("pull_all started with override = %s", self.override)
+
+        plan = self.plan(diff.PULL)
+
+        # Deletions and Package Control need extra handling, all other files are copied in parallel
+        copy_items = []
+        for item in plan.items(self.folder(diff.PULL)):
+            if item["type"] == "d" or item["key"] == "Package Control.sublime-settings":
+                self.pull(item)
+            else:
+                copy_items += [item]
+
+        local_dir = os.path.join(sublime.packages_path(), "User")
+        self.make_dirs(copy_items, local_dir)
+        self.copy_items(copy_items, local_dir, self.snapshot.local, self.pull_file)
 
-        for item in diff:
-            self.pull(item)
+        # A planned push assumed that every pull succeeded, plan it again from the snapshot
+        if len(plan):
+            self.plans.pop(diff.PUSH, None)
 
         # Set data for next last sync
-        tools.save_last_data(last_local_data=self.find_files(local_dir), last_remote_data=self.find_files(remote_dir))
+        tools.save_last_data(self.profile, last_local_data=self.snapshot.local.data(), last_remote_data=self.snapshot.remote.data())
 
     def pull(self, item):
-        log.debug("pull started for %s" % item)
+        log.debug("pull started for %s", item)
 
         local_dir = os.path.join(sublime.packages_path(), "User")
         remote_dir = self.settings.get("sync_folder")
 
         # Get data of last sync
-        last_data = tools.load_last_data()
+        last_data = tools.load_last_data(self.profile)
         last_local_data = last_data.get("last_local_data", {})
         last_remote_data = last_data.get("last_remote_data", {})
 
@@ -185,10 +532,9 @@ class Sync(threading.Thread):
                 # Check for an updated Package Control setting file and backup old file
                 if item["key"] == "Package Control.sublime-settings":
                     previous_installed_packages = tools.load_installed_packages(target)
-                    installed_packages = tools.load_installed_packages(item["path"])
 
                 # Check if the watcher detects a file again
-                if last_local_data[item["key"]]["version"] == item["version"]:
+                if last_local_data.get(item["key"]) == item["version"]:
                     log.debug("Already pulled")
                     return
         except:
@@ -200,19 +546,26 @@ class Sync(threading.Thread):
             if not os.path.isdir(target_dir):
                 os.makedirs(target_dir)
                 
-            shutil.copy2(item["path"], target)
-            log.info("Created %s" % target)
-            if not log.isEnabledFor(logger.logging.INFO):
-                print("Package Syncing: Created %s" % target)
+            if self.pull_file(item, target):
+                self.snapshot.local.update(item["key"])
+                log.info("Created %s", target)
+                if not log.isEnabledFor(logger.logging.INFO):
+                    print("Package Syncing: Created %s" % target)
+            else:
+                self.snapshot.local.update(item["key"])
+                log.debug("Unchanged %s", target)
             #
-            last_local_data[item["key"]] = {"path": target, "dir": item["dir"], "version": item["version"]}
-            last_remote_data[item["key"]] = {"path": item["path"], "dir": item["dir"], "version": item["version"]}
+            last_local_data[item["key"]] = item["version"]
+            last_remote_data[item["key"]] = item["version"]
 
         # If a file was delated
         elif item["type"] == "d":
             if os.path.isfile(target):
+                self.snapshot.local.expect(item["key"])
                 os.remove(target)
-                log.info("Deleted %s" % target)
+                self.fingerprints().remove(target)
+                self.signatures().remove(target)
+                log.info("Deleted %s", target)
                 if not log.isEnabledFor(logger.logging.INFO):
                     print("Package Syncing: Deleted %s" % target)
 
@@ -221,6 +574,8 @@ class Sync(threading.Thread):
                 del last_remote_data[item["key"]]
             except:
                 pass
+            self.snapshot.local.remove(item["key"])
+            copier.remove_parts(target_dir, os.path.basename(target) + ".")
 
             # Check if directory is empty and remove it if, just cosmetic issue
             if os.path.isdir(target_dir) and not os.listdir(target_dir):
@@ -231,191 +586,69 @@ class Sync(threading.Thread):
 
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
-            shutil.copy2(item["path"], target)
-            log.info("Updated %s" % target)
-            if not log.isEnabledFor(logger.logging.INFO):
-                print("Package Syncing: Updated %s" % target)
+            if self.pull_file(item, target):
+                self.snapshot.local.update(item["key"])
+                log.info("Updated %s", target)
+                if not log.isEnabledFor(logger.logging.INFO):
+                    print("Package Syncing: Updated %s" % target)
+            else:
+                self.snapshot.local.update(item["key"])
+                log.debug("Unchanged %s", target)
             #
-            last_local_data[item["key"]] = {"path": target, "dir": item["dir"], "version": item["version"]}
-            last_remote_data[item["key"]] = {"path": item["path"], "dir": item["dir"], "version": item["version"]}
+            last_local_data[item["key"]] = item["version"]
+            last_remote_data[item["key"]] = item["version"]
 
         # Set data for next last sync
-        tools.save_last_data(last_local_data=last_local_data, last_remote_data=last_remote_data)
+        tools.save_last_data(self.profile, last_local_data=last_local_data, last_remote_data=last_remote_data)
 
         if item["type"] != "d" and item["key"] == "Package Control.sublime-settings":
-            # Handle Package Control
-            self.pull_package_control(last_data, previous_installed_packages, installed_packages)
-
-    def pull_package_control(self, last_data, previous_installed_packages, installed_packages):
-        # Save items to remove
-        to_install = [item for item in installed_packages if item not in previous_installed_packages]
-        to_remove = [item for item in previous_installed_packages if item not in installed_packages]
-
-        log.debug("install: %s", to_install)
-        log.debug("remove: %s", to_remove)
-
-        # Check for old remove_packages
-        remove_packages = last_data.get("remove_packages", [])
-        remove_packages += [item for item in to_remove if item != "Package Control" and item not in remove_packages]
-
-        log.debug("remove_packages %s", remove_packages)
-
-        if remove_packages:
-            removed_packages = self.remove_packages(remove_packages)
-        else:
-            removed_packages = []
-
-        # Check if new packages are available and run package cleanup to install missing packages
-        if to_install:
-            sublime.set_timeout(self.install_packages, 1000)
-
-        tools.save_last_data(remove_packages=[item for item in remove_packages if item not in removed_packages])
-
-    def install_packages(self):
-        try:
-            # Reset last-run file
-            file_path = os.path.join(sublime.packages_path(), "User", "Package Control.last-run")
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-
-            # Import package_control_cleaner
-            mod = sys.modules["package_control.package_cleanup" if sublime.version()[0] == "2" else "Package Control.package_control.package_cleanup"]
-            package_control_cleaner = mod.PackageCleanup()
-            package_control_cleaner.start()
-        except:
-            print("Package Syncing: Error while loading Package Control")
-
-    def remove_packages(self, packages):
-        log.debug("packages %s", packages)
-
-        # Reset ignored_packages and wait_flag
-        self.ignored_packages = []
-        self.wait_flag = True
-
-        # At first ignore packages on main thread
-        def ignore_packages():
-            settings = sublime.load_settings("Preferences.sublime-settings")
-            self.ignored_packages = settings.get('ignored_packages')
-            settings.set("ignored_packages", self.ignored_packages + [item for item in packages if item not in self.ignored_packages])
-            sublime.save_settings("Preferences.sublime-settings")
-            #
-            self.wait_flag = False
-
-        sublime.set_timeout(ignore_packages, 0)
-
-        # Wait to complete writing ignored_packages
-        while self.wait_flag:
-            time.sleep(0.25)
-
-        # wait for sublime text to ignore packages
-        time.sleep(1)
-
-        removed_packages = []
-        for package in packages[:]:
-            status = self.remove_package(package)
-            if status:
-                removed_packages += [package]
-
-        # Reset wait flag
-        self.wait_flag = True
-
-        # Update ignore packages on main thread
-        def unignore_packages():
-            settings = sublime.load_settings("Preferences.sublime-settings")
-            settings.set("ignored_packages", self.ignored_packages)
-            sublime.save_settings("Preferences.sublime-settings")
-            #
-            self.wait_flag = False
-
-        sublime.set_timeout(unignore_packages, 1000)
+            # Handle Package Control, the pulled file has the content of the remote one
+            installed_packages = tools.load_installed_packages(target)
+            with self.timer("package control"):
+                self.pull_package_control(previous_installed_packages, installed_packages)
 
-        # Wait to complete writing ignored_packages
-        while self.wait_flag:
-            time.sleep(0.25)
-
-        return removed_packages
-
-    def remove_package(self, package):
-        # Check for installed_package path
-        try:
-            installed_package_path = os.path.join(sublime.installed_packages_path(), package + ".sublime-package")
-            if os.path.exists(installed_package_path):
-                os.remove(installed_package_path)
-        except:
-            return False
-
-        # Check for pristine_package_path path
-        try:
-            pristine_package_path = os.path.join(os.path.dirname(sublime.packages_path()), "Pristine Packages", package + ".sublime-package")
-            if os.path.exists(pristine_package_path):
-                os.remove(pristine_package_path)
-        except:
-            return False
-
-        # Check for package dir
-        try:
-            os.chdir(sublime.packages_path())
-            package_dir = os.path.join(sublime.packages_path(), package)
-            if os.path.exists(package_dir):
-                if shutil.rmtree(package_dir):
-                    open(os.path.join(package_dir, 'package-control.cleanup'), 'w').close()
-        except:
-            return False
-
-        return True
+    def pull_package_control(self, previous_installed_packages, installed_packages):
+        # Several pulls in a row are collected, only their net difference is applied
+        packages.reconciler.update(previous_installed_packages, installed_packages, self.settings.get("package_control_delay", 5))
 
     def push_all(self):
-        log.debug("push_all started with override = %s" % self.override)
+        log.debug("push_all started with override = %s", self.override)
 
-        local_dir = os.path.join(sublime.packages_path(), "User")
-        remote_dir = self.settings.get("sync_folder")
-
-        local_data = self.find_files(local_dir)
-        remote_data = self.find_files(remote_dir)
-
-        # Get data of last sync
-        last_data = tools.load_last_data()
-        last_local_data = last_data.get("last_local_data", {})
-        last_remote_data = last_data.get("last_remote_data", {})
+        plan = self.plan(diff.PUSH)
 
-        deleted_local_data = [key for key in last_local_data if key not in local_data]
-        deleted_remote_data = [key for key in last_remote_data if key not in remote_data]
+        # Deletions need extra handling, all other files are copied in parallel. A pack store
+        # writes all changes together into one pack and its index at the end of the batch
+        with pack.Batch(self.store):
+            copy_items = []
+            for item in plan.items(self.folder(diff.PUSH)):
+                if item["type"] == "d":
+                    self.push(item)
+                else:
+                    copy_items += [item]
 
-        log.debug("local_data: %s" % local_data)
-        log.debug("remote_data: %s" % remote_data)
-        log.debug("deleted_local_data: %s" % deleted_local_data)
-        log.debug("deleted_remote_data: %s" % deleted_remote_data)
-
-        diff = [{"type": "d", "key": key} for key in last_local_data if key not in local_data]
-        for key, value in local_data.items():
-            if key in deleted_remote_data:
-                pass
-            elif key not in remote_data:
-                diff += [dict({"type": "c", "key": key}, **value)]
-            elif int(value["version"]) > int(remote_data[key]["version"]) or self.override:
-                diff += [dict({"type": "m", "key": key}, **value)]
-
-        for item in diff:
-            self.push(item)
+            remote_dir = self.settings.get("sync_folder")
+            if not self.store:
+                self.make_dirs(copy_items, remote_dir)
+            self.copy_items(copy_items, remote_dir, self.snapshot.remote, self.push_file)
 
         # Set data for next last sync
-        tools.save_last_data(last_local_data=self.find_files(local_dir), last_remote_data=self.find_files(remote_dir))
+        tools.save_last_data(self.profile, last_local_data=self.snapshot.local.data(), last_remote_data=self.snapshot.remote.data())
 
     def push(self, item):
-        log.debug("push started for %s" % item)
+        log.debug("push started for %s", item)
 
         local_dir = os.path.join(sublime.packages_path(), "User")
         remote_dir = self.settings.get("sync_folder")
 
         # Get data of last sync
-        last_data = tools.load_last_data()
+        last_data = tools.load_last_data(self.profile)
         last_local_data = last_data.get("last_local_data", {})
         last_remote_data = last_data.get("last_remote_data", {})
 
         # Skip if file was just copied
         try:
             if item["type"] == "c" or item["type"] == "m":
-                if last_remote_data[item["key"]]["version"] == item["version"]:
+                if last_remote_data.get(item["key"]) == item["version"]:
                     log.debug("Already pushed")
                     return
         except:
@@ -427,21 +660,36 @@ class Sync(threading.Thread):
 
         if item["type"] == "c":
 
-            if not os.path.isdir(target_dir):
+            if not self.store and not os.path.isdir(target_dir):
                 os.makedirs(target_dir)
 
-            shutil.copy2(item["path"], target)
-            log.info("Created %s" % target)
-            if not log.isEnabledFor(logger.logging.INFO):
-                print("Package Syncing: Created %s" % target)
+            if self.push_file(item, target):
+                self.snapshot.remote.update(item["key"])
+                log.info("Created %s", target)
+                if not log.isEnabledFor(logger.logging.INFO):
+                    print("Package Syncing: Created %s" % target)
+            else:
+                self.snapshot.remote.update(item["key"])
+                log.debug("Unchanged %s", target)
             #
-            last_local_data[item["key"]] = {"path": item["path"], "dir": item["dir"], "version": item["version"]}
-            last_remote_data[item["key"]] = {"path": target, "dir": item["dir"], "version": item["version"]}
+            last_local_data[item["key"]] = item["version"]
+            last_remote_data[item["key"]] = item["version"]
 
         elif item["type"] == "d":
-            if os.path.isfile(target):
+            if self.store:
+                self.snapshot.remote.expect(item["key"])
+                deleted = self.store.remove(item["key"])
+            elif os.path.isfile(target):
+                self.snapshot.remote.expect(item["key"])
                 os.remove(target)
-                log.info("Deleted %s" % target)
+                self.fingerprints().remove(target)
+                self.signatures().remove(target)
+                deleted = True
+            else:
+                deleted = False
+
+            if deleted:
+                log.info("Deleted %s", target)
                 if not log.isEnabledFor(logger.logging.INFO):
                     print("Package Syncing: Deleted %s" % target)
 
@@ -450,21 +698,28 @@ class Sync(threading.Thread):
                 del last_remote_data[item["key"]]
             except:
                 pass
+            self.snapshot.remote.remove(item["key"])
+            if not self.store:
+                copier.remove_parts(target_dir, os.path.basename(target) + ".")
 
             # Check if dir is empty and remove it if
             if os.path.isdir(target_dir) and not os.listdir(target_dir):
                 os.rmdir(target_dir)
 
         elif item["type"] == "m":
-            if not os.path.isdir(target_dir):
+            if not self.store and not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
-            shutil.copy2(item["path"], target)
-            log.info("Updated %s" % target)
-            if not log.isEnabledFor(logger.logging.INFO):
-                print("Package Syncing: Updated %s" % target)
+            if self.push_file(item, target):
+                self.snapshot.remote.update(item["key"])
+                log.info("Updated %s", target)
+                if not log.isEnabledFor(logger.logging.INFO):
+                    print("Package Syncing: Updated %s" % target)
+            else:
+                self.snapshot.remote.update(item["key"])
+                log.debug("Unchanged %s", target)
             #
-            last_local_data[item["key"]] = {"path": item["path"], "dir": item["dir"], "version": item["version"]}
-            last_remote_data[item["key"]] = {"path": target, "dir": item["dir"], "version": item["version"]}
+            last_local_data[item["key"]] = item["version"]
+            last_remote_data[item["key"]] = item["version"]
 
         # Set data for next last sync
-        tools.save_last_data(last_local_data=last_local_data, last_remote_data=last_remote_data)
+        tools.save_last_data(self.profile, last_local_data=last_local_data, last_remote_data=last_remote_data)
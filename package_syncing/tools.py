@@ -3,56 +3,171 @@ import sublime_plugin
 
 import json
 import os
+import re
 import time
+import uuid
 
 if sublime.version()[0] == "2":
     from codecs import open
 
 try:
     from . import logger
+    from . import matcher
+    from . import pack
+    from . import snapshot
+    from . import state
     from . import watcher
 except:
     from package_syncing import logger
+    from package_syncing import matcher
+    from package_syncing import pack
+    from package_syncing import snapshot
+    from package_syncing import state
     from package_syncing import watcher
 
 log = logger.getLogger(__name__)
 
 watcher_local = None
-watcher_remote = None
+# Profile name -> remote watcher
+watchers_remote = {}
+# Profile name -> last-run state, the default profile has the name ""
+last_runs = {}
+
+# Version of the last-run file layout
+LAST_RUN_FORMAT = 2
 
 
 def load_settings():
     s = sublime.load_settings("Package Syncing.sublime-settings")
-    return {
+    settings = {
         "sync": s.get("sync", False),
         "sync_folder": s.get("sync_folder", False),
         "sync_interval": s.get("sync_interval", 1),
+        "max_sync_interval": s.get("max_sync_interval", 10),
+        "remote_sync_interval": s.get("remote_sync_interval", 2),
+        "remote_max_sync_interval": s.get("remote_max_sync_interval", 30),
+        "remote_format": s.get("remote_format", "files"),
+        "coalesce_interval": s.get("coalesce_interval", 0.5),
+        "watcher_backend": s.get("watcher_backend", "auto"),
+        "compare_content": s.get("compare_content", True),
+        "copy_concurrency": s.get("copy_concurrency", 4),
+        "copy_chunk_size": s.get("copy_chunk_size", 1048576),
+        "delta_transfer": s.get("delta_transfer", False),
+        "delta_block_size": s.get("delta_block_size", 16384),
+        "package_control_delay": s.get("package_control_delay", 5),
+        "metrics_file": s.get("metrics_file", ""),
+        "metrics_limit": s.get("metrics_limit", 100),
         "files_to_include": s.get("files_to_include", []),
         "files_to_ignore": s.get("files_to_ignore", []),
-        "dirs_to_ignore": s.get("dirs_to_ignore", [])
+        "dirs_to_ignore": s.get("dirs_to_ignore", []),
+        "profiles": s.get("profiles", {})
     }
+    settings["matcher"] = load_matcher(settings)
+    settings["profile"] = ""
+    return settings
 
 
-def load_last_data():
-    try:
-        with open(os.path.join(sublime.packages_path(), "User", "Package Syncing.last-run"), "r", encoding="utf8") as f:
-            file_json = json.load(f)
-    except:
-        file_json = {}
-    return file_json
+def load_profiles(settings):
+    # Settings of every sync target, the sync_folder of the settings is the default profile
+    # and each named profile overrides some of the settings for another folder
+    profiles = [settings] if settings.get("sync_folder") else []
+    for name, overrides in sorted(settings.get("profiles", {}).items()):
+        profile = dict(settings, **overrides)
+        if not name or not profile.get("sync_folder") or profile["sync_folder"] == settings.get("sync_folder"):
+            log.debug("Profile \"%s\" needs a sync_folder of its own", name)
+            continue
+        profile["profile"] = name
+        profile["matcher"] = load_matcher(profile)
+        profiles += [profile]
+    return profiles
 
 
-def save_last_data(**kwargs):
-    # Load current file
-    file_json = load_last_data()
-    # Save new values
-    for key, value in kwargs.items():
-        file_json[key] = value
-    try:
-        with open(os.path.join(sublime.packages_path(), "User", "Package Syncing.last-run"), "w", encoding="utf8") as f:
-            json.dump(file_json, f, sort_keys=True, indent=4)
-    except Exception as e:
-        log.warning("Error while saving Packages Syncing.last-run %s" % e)
+def get_profile(settings, name):
+    for profile in load_profiles(settings):
+        if profile["profile"] == name:
+            return profile
+    return None
+
+
+def load_local_matcher(settings):
+    # The local folder is scanned and watched once for the files of all profiles
+    profiles = load_profiles(settings)
+    if not profiles:
+        return settings["matcher"]
+    return matcher.get_union_matcher([profile["matcher"] for profile in profiles])
+
+
+def load_matcher(settings):
+    # Matchers are cached by their patterns, so this is cheap for unchanged settings
+    return matcher.get_matcher(settings.get("files_to_include", []), settings.get("files_to_ignore", []), settings.get("dirs_to_ignore", []))
+
+
+def load_store(settings):
+    # Pack store of the sync folder, None if the files are mirrored one by one
+    if settings.get("remote_format", "files") != "pack" or not settings.get("sync_folder"):
+        return None
+    return pack.get_store(settings.get("sync_folder"), machine_id())
+
+
+def machine_id():
+    # Names the pack index of this machine, created once and kept in the last-run data
+    machine = load_last_data().get("machine")
+    if not machine:
+        machine = uuid.uuid4().hex[:12]
+        save_last_data(machine=machine)
+        flush_last_data(1, "")
+    return machine
+
+
+def get_last_run(profile=""):
+    # The last-run file is only read once and then kept in memory, every profile has its own
+    if profile not in last_runs:
+        name = "Package Syncing.%s.last-run" % re.sub(r"[^\w.-]", "_", profile) if profile else "Package Syncing.last-run"
+        last_runs[profile] = state.State(os.path.join(sublime.packages_path(), "User", name))
+    return last_runs[profile]
+
+
+def load_last_data(profile=""):
+    data = get_last_run(profile).load()
+    if data.get("format", 1) < LAST_RUN_FORMAT:
+        migrate_last_data(data, profile)
+    return data
+
+
+def migrate_last_data(data, profile=""):
+    changes = {"format": LAST_RUN_FORMAT}
+
+    # Older versions kept the path and dir of every file, only the version is needed
+    for name in ["last_local_data", "last_remote_data"]:
+        values = data.get(name, {})
+        changes[name] = dict([(key, value["version"] if isinstance(value, dict) else value) for key, value in values.items()])
+
+    # Cached file data was stored by absolute path, now it is relative to the synced folders
+    for name in ["fingerprints", "signatures"]:
+        values = data.get(name, {})
+        changes[name] = dict([(key, value) for key, value in values.items() if not os.path.isabs(key)])
+
+    log.debug("migrated last-run data to format %s", LAST_RUN_FORMAT)
+    get_last_run(profile).update(**changes)
+
+
+def save_last_data(profile="", **kwargs):
+    # Changes are only written to disk by flush_last_data
+    get_last_run(profile).update(**kwargs)
+
+
+def flush_last_data(delay=0, profile=None):
+    # Writes the data of one profile, or of all of them
+    for name in [profile] if profile is not None else list(last_runs.keys()):
+        get_last_run(name).flush(delay)
+
+
+def reset_last_data(profile=""):
+    # The machine keeps its pack index
+    machine = load_last_data().get("machine")
+    get_last_run(profile).reset()
+    if machine and not profile:
+        save_last_data(machine=machine)
 
 
 def load_installed_packages(path):
@@ -65,64 +180,122 @@ def load_installed_packages(path):
     return file_json.get("installed_packages", [])
 
 
-def start_watcher(settings, local=True, remote=True):
+def start_watcher(settings, local=True, remote=True, profile=None):
     global watcher_local
-    global watcher_remote
 
     if not settings.get("sync", False):
         return
 
     # Build required options for the watcher
     local_dir = os.path.join(sublime.packages_path(), "User")
-    remote_dir = settings.get("sync_folder")
     sync_interval = settings.get("sync_interval")
-    files_to_include = settings.get("files_to_include", [])
-    files_to_ignore = settings.get("files_to_ignore", []) + ["Package Syncing.sublime-settings", "Package Syncing.last-run"]
-    dirs_to_ignore = settings.get("dirs_to_ignore", [])
+    coalesce_interval = settings.get("coalesce_interval", 0.5)
+    backend = settings.get("watcher_backend", "auto")
+    watcher_thread = watcher.get_watcher_thread(backend)
 
-    # Create local watcher
+    # Create local watcher, its changes are pushed to every profile
     if local:
-        watcher_local = watcher.WatcherThread(local_dir, "pkg_sync_push_item", sync_interval, files_to_include, files_to_ignore, dirs_to_ignore)
+        watcher_local = watcher_thread(local_dir, "pkg_sync_push_item", sync_interval, load_local_matcher(settings), coalesce_interval, max_interval=settings.get("max_sync_interval"))
         watcher_local.start()
 
-    # Create remote watcher
+    # Create remote watchers, a pack store only needs the modification time of its index
     if remote:
-        watcher_remote = watcher.WatcherThread(remote_dir, "pkg_sync_pull_item", sync_interval, files_to_include, files_to_ignore, dirs_to_ignore)
-        watcher_remote.start()
+        for profile_settings in load_profiles(settings):
+            name = profile_settings["profile"]
+            if profile is not None and name != profile:
+                continue
 
+            store = load_store(profile_settings)
+            # Writes of other machines to a network share raise no inotify events, so the
+            # sync folder is polled unless inotify was chosen explicitly
+            remote_thread = watcher.WatcherThread if store else watcher.get_watcher_thread("poll" if backend == "auto" else backend)
+            remote_sync_interval = profile_settings.get("remote_sync_interval", sync_interval)
+            watchers_remote[name] = remote_thread(profile_settings.get("sync_folder"), "pkg_sync_pull_item", remote_sync_interval, profile_settings["matcher"], coalesce_interval, store, profile_settings.get("remote_max_sync_interval"), {"profile": name})
+            watchers_remote[name].start()
+
+
+def remote_watchers(profile=None):
+    return [watcher_thread for name, watcher_thread in watchers_remote.items() if profile is None or name == profile]
 
-def pause_watcher(status=True, local=True, remote=True):
-    global watcher_local
-    global watcher_remote
 
+def pause_watcher(status=True, local=True, remote=True, profile=None):
     # Pause local watcher
     if watcher_local and local:
         watcher_local.pause(status)
 
-    # Pause remote watcher
-    if watcher_remote and remote:
-        watcher_remote.pause(status)
+    # Pause remote watchers, only the one of profile if given
+    if remote:
+        for watcher_thread in remote_watchers(profile):
+            watcher_thread.pause(status)
 
 
 def restart_watcher():
-    settings = load_settings()
-    #
-    pause_watcher(local=False)
-    stop_watcher(local=False)
-    start_watcher(load_settings(), local=False)
+    # Filters of the profiles are watched together, so the local watcher is restarted as well
+    pause_watcher()
+    stop_watcher()
+    start_watcher(load_settings())
 
     # Run pkg_sync
     sublime.set_timeout(lambda: sublime.run_command("pkg_sync", {"mode": ["pull", "push"]}), 1000)
 
 
 def stop_watcher(local=True, remote=True):
-    global watcher_local
-    global watcher_remote
-
     # Stop local watcher
     if watcher_local and local:
         watcher_local.stop = True
+        watcher_local.poke()
+
+    # Stop remote watchers
+    if remote:
+        for watcher_thread in remote_watchers():
+            watcher_thread.stop = True
+            watcher_thread.poke()
+        watchers_remote.clear()
+
+
+def poke_watcher(path):
+    # Poll the folder of path right away, e.g. after it was saved in Sublime Text
+    for watcher_thread in [watcher_local] + remote_watchers():
+        if watcher_thread and not watcher_thread.stop and path.startswith(os.path.join(watcher_thread.folder, "")):
+            watcher_thread.poke()
+
+
+def saved_item(path):
+    # Push item for a file saved in Sublime Text, None if it is not synced
+    settings = load_settings()
+    if not settings.get("sync", False) or not load_profiles(settings):
+        return None
+
+    local_dir = os.path.join(sublime.packages_path(), "User")
+    if not path.startswith(os.path.join(local_dir, "")):
+        return None
+
+    key = path[len(local_dir) + 1:]
+    local_matcher = load_local_matcher(settings)
+    if not local_matcher.match_path(key):
+        return None
+
+    index = snapshot.get_index(local_dir, local_matcher)
+    created = index.get(key) is None
+    version = index.update(key)
+    if version is None:
+        return None
+
+    # The local watcher must not report the same change again
+    if watcher_local and not watcher_local.stop:
+        watcher_local.watcher.acknowledge(key, version)
+
+    return snapshot.make_item(local_dir, key, version, "c" if created else "m")
+
 
-    # Stop remote watcher
-    if watcher_remote and remote:
-        watcher_remote.stop = True
+def show_panel(window, name, text):
+    # Show text in an output panel, Sublime Text 2 has no append command
+    if sublime.version()[0] == "2":
+        panel = window.get_output_panel(name)
+        edit = panel.begin_edit()
+        panel.insert(edit, 0, text)
+        panel.end_edit(edit)
+    else:
+        panel = window.create_output_panel(name)
+        panel.run_command("append", {"characters": text})
+    window.run_command("show_panel", {"panel": "output.%s" % name})
@@ -2,42 +2,66 @@ import sublime
 import sublime_plugin
 
 import errno
-import fnmatch
 import os
 import stat
 import threading
-import time
 
 try:
+    from . import inotify
     from . import logger
+    from . import snapshot
+    from . import stats
 except ValueError:
+    from package_syncing import inotify
     from package_syncing import logger
+    from package_syncing import snapshot
+    from package_syncing import stats
 
 log = logger.getLogger(__name__)
 
+# Factor by which the poll interval grows while nothing changes
+BACKOFF = 2
+
 
 class WatcherThread(threading.Thread):
 
     stop = False
 
-    def __init__(self, folder, callback, sync_interval, files_to_include=[], files_to_ignore=[], dirs_to_ignore=[]):
+    def __init__(self, folder, callback, sync_interval, matcher, coalesce_interval=0.5, store=None, max_interval=None, args=None):
         self.folder = folder
         self.callback = callback
 
+        # Polls back off from sync_interval up to max_interval while the folder is unchanged
         self.sync_interval = sync_interval
+        self.max_interval = max(sync_interval, max_interval or sync_interval)
+        self.interval = sync_interval
+        self.wake = threading.Event()
+        self.matcher = matcher
 
-        self.files_to_include = files_to_include
-        self.files_to_ignore = files_to_ignore
-        self.dirs_to_ignore = dirs_to_ignore
-
-        self.watcher = Watcher(self.folder, self.callback, self.files_to_include, self.files_to_ignore, self.dirs_to_ignore)
+        # The files are listed by the thread, not by the caller
+        self.watcher = Watcher(self.folder, Coalescer(self.callback, coalesce_interval, args), self.matcher, store)
 
         threading.Thread.__init__(self)
 
     def run(self):
+        self.watcher.start()
+
         while not self.stop:
-            self.watcher.loop()
-            time.sleep(self.sync_interval)
+            with stats.collector.timer("watcher poll"):
+                changed = self.watcher.loop()
+
+            if changed:
+                self.interval = self.sync_interval
+            else:
+                self.interval = min(self.interval * BACKOFF, self.max_interval)
+
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def poke(self):
+        # Poll right away and at the fast rate again, e.g. after a file was saved
+        self.interval = self.sync_interval
+        self.wake.set()
 
     def pause(self, status=True):
         # Update file list before unpause watcher
@@ -46,98 +70,281 @@ class WatcherThread(threading.Thread):
         self.watcher.pause = status
 
 
-class Watcher(object):
+class InotifyWatcherThread(WatcherThread):
 
-    pause = True
+    def __init__(self, *args, **kwargs):
+        WatcherThread.__init__(self, *args, **kwargs)
+        self.inotify = None
+        self.watch_dirs = {}
 
-    def __init__(self, folder, callback, files_to_include=[], files_to_ignore=[], dirs_to_ignore=[]):
+    def run(self):
+        self.watcher.start()
+
+        try:
+            self.inotify = inotify.Inotify()
+            self.add_watches(self.folder)
+        except (OSError, AttributeError) as e:
+            # The libc of macOS and Windows has no inotify functions at all
+            log.warning("inotify not usable for %s, falling back to polling: %s", self.folder, e)
+            self.close()
+            return WatcherThread.run(self)
+
+        # Catch changes which happend between the initial scan and the first watch
+        self.watcher.loop()
+
+        try:
+            while not self.stop:
+                # Wake up regularly to notice the stop flag
+                events = self.inotify.read(self.sync_interval)
+                if events:
+                    with stats.collector.timer("watcher events"):
+                        self.process_events(events)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self.watch_dirs = {}
+
+    def add_watches(self, path):
+        for root, dir_names, file_names in os.walk(path):
+            [dir_names.remove(d) for d in dir_names[:] if self.matcher.ignore_dir(d)]
+
+            wd = self.inotify.add_watch(root)
+            self.watch_dirs[wd] = root
+            log.trace("inotify watching %s", root)
+
+    def remove_watches(self, path):
+        for wd, root in list(self.watch_dirs.items()):
+            if root == path or root.startswith(path + os.sep):
+                self.inotify.rm_watch(wd)
+                del self.watch_dirs[wd]
+
+    def process_events(self, events):
+        keys = []
+        rescan = False
+
+        for event in events:
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                rescan = True
+                continue
+
+            root = self.watch_dirs.get(event.wd)
+            if root is None:
+                continue
+
+            # Watch was removed by the kernel, directory is gone
+            if event.mask & inotify.IN_IGNORED:
+                del self.watch_dirs[event.wd]
+                continue
+
+            if not event.name:
+                continue
+
+            full_path = os.path.join(root, event.name)
+
+            if event.mask & inotify.IN_ISDIR:
+                if self.matcher.ignore_dir(event.name):
+                    continue
+                # Directories moved away keep their watch, but the stored root is outdated
+                if event.mask & inotify.IN_MOVED_FROM:
+                    self.remove_watches(full_path)
+                # New or moved directories have to be watched and might already contain files
+                if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    try:
+                        self.add_watches(full_path)
+                    except OSError as e:
+                        log.debug("Unable to watch %s: %s", full_path, e)
+                rescan = True
+                continue
+
+            key = os.path.relpath(full_path, self.folder)
+            if key not in keys:
+                keys += [key]
+
+        if rescan:
+            self.watcher.loop()
+        else:
+            for key in keys:
+                self.watcher.check_path(key)
 
-        self.folder = folder
+
+def get_watcher_thread(backend="auto"):
+    if backend == "poll":
+        return WatcherThread
+    if backend == "inotify" or (backend == "auto" and inotify.available()):
+        return InotifyWatcherThread
+    return WatcherThread
+
+
+class Coalescer(object):
+
+    # (previous type, new type) -> merged type, None drops the item
+    MERGE = {
+        ("c", "m"): "c",
+        ("c", "d"): None,
+        ("m", "c"): "m",
+        ("d", "c"): "m",
+        ("d", "m"): "m"
+    }
+
+    def __init__(self, callback, interval=0.5, args=None):
+        # args are passed to the callback along with the items
         self.callback = callback
+        self.interval = interval
+        self.args = args or {}
+
+        self.keys = []
+        self.items = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            key = item["key"]
+            if key in self.items:
+                previous_type = self.items[key]["type"]
+                item_type = self.MERGE.get((previous_type, item["type"]), item["type"])
+                if item_type is None:
+                    log.trace("Dropped %s", key)
+                    del self.items[key]
+                    self.keys.remove(key)
+                    return
+                item = dict(item, type=item_type)
+            else:
+                self.keys += [key]
+            self.items[key] = item
+
+            # Collect further events until the window is over
+            if not self.timer:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            items = [self.items[key] for key in self.keys]
+            self.keys = []
+            self.items = {}
+            self.timer = None
 
-        self.files_to_include = files_to_include
-        self.files_to_ignore = files_to_ignore
-        self.dirs_to_ignore = dirs_to_ignore
+        if items:
+            log.debug("dispatching %s items to %s", len(items), self.callback)
+            args = dict(self.args, items=items)
+            sublime.set_timeout(lambda: sublime.run_command(self.callback, args), 0)
 
-        self.files_map = {}
 
-        self.update_files()
-        self.pause = False
+class Watcher(object):
+
+    pause = False
+
+    def __init__(self, folder, coalescer, matcher, store=None):
+
+        self.folder = folder
+        self.coalescer = coalescer
+        self.matcher = matcher
+
+        # Key -> version of the watched files, None until start was called
+        self.files_map = None
+        self.changes = 0
+        self.index = snapshot.get_index(self.folder, self.matcher, store)
 
     def __del__(self):
-        for key, value in self.files_map.items():
-            log.debug("unwatching %s" % value["path"])
+        for key in self.files_map or {}:
+            log.debug("unwatching %s", key)
 
-    def listdir(self, walk=False):
-        items = []
-        for root, dir_names, file_names in os.walk(self.folder):
-            [dir_names.remove(d) for d in dir_names if d in self.dirs_to_ignore]
+    def start(self):
+        # Files already known to the snapshot are not listed again, anything which differs
+        # from it is reported by the first loop
+        files = self.index.data() if self.index.scanned else self.listdir()
+        log.debug("watching %s files in %s", len(files), self.folder)
+        self.files_map = files
 
-            for file_name in file_names:
-                full_path = os.path.join(root, file_name)
-                rel_path = os.path.relpath(full_path, self.folder)
+    def listdir(self, walk=False):
+        return self.index.refresh()
 
-                include_matches = [fnmatch.fnmatch(rel_path, p) for p in self.files_to_include]
-                ignore_matches = [fnmatch.fnmatch(rel_path, p) for p in self.files_to_ignore]
+    def check_path(self, key):
+        if self.files_map is None or not self.matcher.match_path(key):
+            return
 
-                if any(ignore_matches) or not any(include_matches):
-                    continue
+        # A vanished folder, e.g. an unmounted drive, does not delete its files
+        if not os.path.isdir(self.folder):
+            return
 
-                items += [{"key": rel_path, "path": full_path, "dir": os.path.dirname(rel_path), "version": os.path.getmtime(full_path)}]
+        # Keep the shared snapshot up to date without a rescan
+        version = self.index.update(key) if os.path.isfile(os.path.join(self.folder, key)) else self.index.remove(key)
+        if version is not None:
+            if key in self.files_map:
+                self.check_version(key, version)
+            else:
+                self.watch(key, version)
+        elif key in self.files_map:
+            self.unwatch(key)
 
-        return items
+    def acknowledge(self, key, version):
+        # A change synced by other means, e.g. on save, is not reported by the next poll
+        if self.files_map is not None:
+            self.files_map[key] = version
 
     def loop(self):
-        self.update_files()
-        for key, value in self.files_map.items():
-            self.check_file(key, value)
+        # Returns whether a change was passed on
+        if self.files_map is None:
+            return False
+        changes = self.changes
+        self.update_files(check=True)
+        return self.changes != changes
 
-    def check_file(self, key, value):
-        file_mtime = os.path.getmtime(value["path"])
-        if file_mtime != value["version"]:
-            self.files_map[key]["version"] = file_mtime
-            item = dict({"type": "m"}, **value)
+    def check_version(self, key, file_mtime):
+        if file_mtime != self.files_map[key]:
+            self.files_map[key] = file_mtime
 
             # Run callback if file changed
-            if not self.pause:
-                sublime.set_timeout(lambda: sublime.run_command(self.callback, {"item": item}), 0)
-            else:
-                log.trace("Skip %s", item)
+            self.notify("m", key, file_mtime)
 
-    def update_files(self):
-        items = []
+    def update_files(self, check=False):
+        # A vanished folder, e.g. an unmounted drive, does not delete its files
+        if not os.path.isdir(self.folder):
+            log.debug("%s is missing, skipping", self.folder)
+            return
 
-        for item in self.listdir():
-            if item["key"] not in self.files_map:
-                items += [item]
+        files = self.listdir()
 
         # check existent files
-        for key, value in self.files_map.copy().items():
-            if not os.path.exists(value["path"]):
-                self.unwatch(value)
+        for key in list(self.files_map.keys()):
+            if key not in files:
+                self.unwatch(key)
 
-        for item in items:
-            if item["key"] not in self.files_map:
-                self.watch(item)
+        for key, version in files.items():
+            if key not in self.files_map:
+                self.watch(key, version)
+            elif check:
+                self.check_version(key, version)
 
-    def watch(self, item):
-        log.debug("watching %s" % item["path"])
-        self.files_map[item["key"]] = item
-        item = dict({"type": "c"}, **item)
+    def watch(self, key, version):
+        log.debug("watching %s", key)
+        self.files_map[key] = version
 
         # Run callback if file created
-        if not self.pause:
-            sublime.set_timeout(lambda: sublime.run_command(self.callback, {"item": item}), 0)
-        else:
-            log.trace("Skip %s", item)
+        self.notify("c", key, version)
 
-    def unwatch(self, item):
-        log.debug("unwatching %s" % item["path"])
-        del self.files_map[item["key"]]
-        item = dict({"type": "d"}, **item)
+    def unwatch(self, key):
+        log.debug("unwatching %s", key)
+        version = self.files_map.pop(key)
 
         # Run callback if file deleted
+        self.notify("d", key, version)
+
+    def notify(self, item_type, key, version):
+        # Changes made by the sync itself are dropped right away
+        if self.index.is_echo(key, version if item_type != "d" else None):
+            log.trace("Echo %s %s", item_type, key)
+            return
+
+        # Pass changes to the coalescer, which runs the callback for a batch of items
         if not self.pause:
-            sublime.set_timeout(lambda: sublime.run_command(self.callback, {"item": item}), 0)
+            self.changes += 1
+            self.coalescer.add(snapshot.make_item(self.folder, key, version, item_type))
         else:
-            log.trace("Skip %s", item)
+            log.trace("Skip %s %s", item_type, key)